@@ -3,12 +3,21 @@
 import pglast
 from pglast.stream import RawStream
 import psycopg2
-from copy import copy, deepcopy
 import time
 import os
 import sys
 import yaml
 
+from sqlreduce.guard import guard_prefix
+from sqlreduce.pipeline import pipeline_available, run_queries_pipelined
+from sqlreduce import stats
+from sqlreduce.stream import CachedStream
+from sqlreduce.treehash import node_hash, replaced_hash
+from sqlreduce.watchdog import default_hang_timeout, Watchdog
+from sqlreduce import position
+from sqlreduce import semantic
+from sqlreduce import tuning
+
 def getattr_path(obj, path):
     if path == []:
         return obj
@@ -17,33 +26,135 @@ def getattr_path(obj, path):
     else:
         return getattr_path(getattr(obj, path[0]), path[1:])
 
+def copy_node(node):
+    """Shallow copy of a parse tree node (copy() would also copy the node's tuples)"""
+    node2 = object.__new__(type(node))
+    for attr in node:
+        object.__setattr__(node2, attr, getattr(node, attr))
+    return node2
+
 def setattr_path(obj, path, node):
+    """Return a copy of obj with the node at path replaced by node. Only the
+    nodes along the path are copied, all other subtrees are shared with obj."""
     if path == []:
         return node
-    obj2 = deepcopy(obj)
-    parent = getattr_path(obj2, path[:-1])
-    if type(path[-1]) == int:
-        return setattr_path(obj2, path[:-1], parent[:path[-1]] + (node,) + parent[path[-1]+1:])
-    else:
-        setattr(parent, path[-1], node)
+    if type(path[0]) == int:
+        return obj[:path[0]] + (setattr_path(obj[path[0]], path[1:], node),) + obj[path[0]+1:]
+    obj2 = copy_node(obj)
+    setattr(obj2, path[0], setattr_path(getattr(obj, path[0]), path[1:], node))
     return obj2
 
-def run_query(state, query):
-    # establish connection and wait for it to be ready
+def connection_params(state, database=None):
+    """Connection parameters for database, including the session settings"""
+
+    # statement_timeout is passed as session default so it survives DISCARD ALL
+    params = psycopg2.extensions.parse_dsn(database or state.database)
+    timeout = state.timeout.replace(' ', '\\ ')
+    params['options'] = (params.get('options', '') + f" -c statement_timeout={timeout}").strip()
+    if state.guard is not None:
+        params['options'] += ' ' + state.guard.options()
+    if state.session_settings:
+        params['options'] += ' ' + tuning.options(state.session_settings)
+    return params
+
+def connect(state, database=None):
+    """Establish connection and wait for it to be ready"""
+
+    params = connection_params(state, database)
     while True:
         try:
-            conn = psycopg2.connect(state['database'], fallback_application_name='sqlreduce')
-            cur = conn.cursor()
-            cur.execute("set statement_timeout = %s", (state['timeout'],))
-            break
+            conn = psycopg2.connect(fallback_application_name='sqlreduce', **params)
+            conn.autocommit = True
+            return conn
         except Exception as e:
             time.sleep(.2)
 
+def settable_settings(cur, names):
+    """The settings of names the connected user can pass in the connection
+    options; connecting fails if any other is given"""
+
+    # superuser-only settings can be granted to other roles from PostgreSQL 15 on
+    granted = "has_parameter_privilege(name, 'set')" if cur.connection.server_version >= 150000 else "false"
+    cur.execute(f"""select name from pg_settings where name = any(%s) and
+            (context in ('user', 'backend') or (context in ('superuser', 'superuser-backend') and
+            (current_setting('is_superuser')::bool or {granted})))""", (list(names),))
+    return {row[0] for row in cur.fetchall()}
+
+def run_query(state, query):
+    """Run query and return the error message or SQL state it yields. With an
+    oracle set, return the outcome determined by the oracle instead."""
+
+    if state.oracle is not None:
+        state.error_position = None
+        return state.oracle.run(state, query)
+    if state.guard is not None:
+        error, _ = run_in_transaction(state, 'conn', state.database, lambda cur: state.guard.execute(cur, query))
+        # the position might be in the EXPLAIN run before the query
+        state.error_position = None
+        if error.startswith(guard_prefix):
+            state.guard_trips += 1
+        return error
+    error, _ = run_in_transaction(state, 'conn', state.database, lambda cur: cur.execute(query))
+    return error
+
+def run_in_transaction(state, conn_attr, database, func):
+    """Call func(cursor) in a transaction on the connection kept in
+    state.<conn_attr>, and roll back. Returns the error message or SQL state
+    (or 'no error'), and the return value of func. state.crashed and
+    state.error_position are set from the outcome."""
+
+    error, result, crashed, position = transaction_outcome(state, conn_attr, database, func)
+    state.crashed = crashed
+    state.error_position, state.error_position_bytes = position or (None, False)
+    if error == 'hang':
+        state.hangs += 1
+    return error, result
+
+def start_watchdog(state):
+    """Create the watchdog thread before threads share state"""
+
+    if state.hang_timeout and state.watchdog is None:
+        state.watchdog = Watchdog()
+
+def transaction_outcome(state, conn_attr, database, func):
+    """Like run_in_transaction(), but leave state.crashed, state.error_position
+    and state.hangs alone, so threads can run queries on different connections
+    of state at the same time. Returns (error, return value of func, crashed,
+    position), where position is (error position, True if counted in bytes)
+    or None."""
+
+    conn = getattr(state, conn_attr)
+    began = False
+    if conn is not None and not conn.closed:
+        try:
+            conn.cursor().execute("begin")
+            began = True
+        except psycopg2.Error:
+            # the connection died while idle (the server was restarted by
+            # someone else), that is not the outcome of the query
+            conn.close()
+    if not began:
+        conn = connect(state, database)
+        setattr(state, conn_attr, conn)
+    cur = conn.cursor()
+
     error = 'no error'
+    result = None
+    crashed = False
+    position = None
+    if state.hang_timeout:
+        start_watchdog(state)
+        state.watchdog.start(conn, state.hang_timeout, database or state.database)
     try:
-        cur.execute(query)
+        if not began:
+            cur.execute("begin")
+        result = func(cur)
     except psycopg2.Error as e:
-        if state['use_sqlstate']:
+        # errors without SQL state are connection failures, i.e. the backend crashed
+        crashed = e.pgcode is None
+        if e.diag.statement_position:
+            position = int(e.diag.statement_position), conn.get_parameter_status('server_encoding') == 'SQL_ASCII'
+        if state.use_sqlstate:
             error = e.pgcode if e.pgcode else "CRASH"
         elif e.pgerror:
             error = e.pgerror.partition('\n')[0]
@@ -51,11 +162,27 @@ def run_query(state, query):
             error = str(e)
     except Exception as e:
         error = str(e)
+
+    # the watchdog had to interrupt the query, don't reuse the connection
+    hung = state.hang_timeout and state.watchdog.stop(conn)
+    if hung:
+        error = 'hang'
+        crashed = False
+        position = None
+
+    # throw away everything the query did, including session state
     try:
-        conn.close()
+        if state.reconnect or hung:
+            raise Exception("don't reuse connection")
+        cur.execute("rollback")
+        cur.execute("discard all")
     except:
-        pass
-    return error
+        try:
+            conn.close()
+        except:
+            pass
+        setattr(state, conn_attr, None)
+    return error, result, crashed, position
 
 def check_connection(database):
     conn = psycopg2.connect(database, fallback_application_name='sqlreduce')
@@ -63,48 +190,137 @@ def check_connection(database):
     cur.execute('select')
     conn.close()
 
-def try_reduce(state, path, node):
-    """In the currently best parse tree, replace path by given node and run query.
-    Returns True when successful."""
-
-    parsetree2 = setattr_path(state['parsetree'], path, node)
-
-    if state['debug']:
+class Cancelled(Exception):
+    """Raised when a reduction is cancelled, state.parsetree holds the best
+    parse tree found so far"""
+
+class BudgetExhausted(Cancelled):
+    """Raised when the time or query budget of a reduction has run out"""
+
+def write_file_atomic(filename, text):
+    """Replace filename with text, readers never see a partially written file"""
+
+    tmp = f"{filename}.tmp{os.getpid()}"
+    with open(tmp, 'w') as f:
+        f.write(text + '\n')
+    os.replace(tmp, filename)
+
+def prepare_candidate(state, path, node):
+    """In the currently best parse tree, replace path by given node.
+    Returns (parsetree, query), or None if the query was seen before."""
+
+    if state.cancelled:
+        raise Cancelled()
+    if state.max_queries is not None and len(state.seen) >= state.max_queries:
+        raise BudgetExhausted()
+    if state.deadline is not None and time.time() >= state.deadline:
+        raise BudgetExhausted()
+
+    # skip structurally identical candidates before building and rendering them
+    state.called += 1
+    tree_hash = replaced_hash(state.parsetree, path, node, state.hash_cache)
+    if tree_hash in state.seen_hashes:
+        state.duplicates += 1
+        if state.debug:
+            print("Setting", path, "to", node, "yields a tree seen before, skipping\n")
+            assert CachedStream(state.text_cache)(setattr_path(state.parsetree, path, node)) in state.seen
+        return None
+
+    # skip candidates failing with "missing FROM-clause entry" and the like
+    if state.pruning and semantic.breaks_references(state, path, node):
+        state.pruned += 1
+        if state.debug:
+            print("Setting", path, "to", node, "breaks name references, skipping\n")
+        return None
+
+    parsetree2 = setattr_path(state.parsetree, path, node)
+
+    if state.debug:
         print("Setting", path, "to", node)
         print(parsetree2)
-    query = RawStream()(parsetree2)
-    state['called'] += 1
-    if query in state['seen']:
-        if state['debug']:
+        assert tree_hash == node_hash(parsetree2, state.hash_cache), "replaced_hash differs from node_hash"
+    query = CachedStream(state.text_cache)(parsetree2)
+    if state.debug:
+        assert query == RawStream()(parsetree2), "CachedStream output differs from RawStream"
+    if query in state.seen:
+        if state.debug:
             print('Query', query, 'was seen before, skipping\n')
-        return False
-    state['seen'].add(query)
-    if state['verbose']:
-        print(query, end='')
+        return None
+    state.seen.add(query)
+    state.seen_hashes.add(tree_hash)
+    if state.stat_classes is not None:
+        state.stat_classes.setdefault(stats.query_fingerprint(query), candidate_class(state.parsetree, path))
+
+    return parsetree2, query
+
+def candidate_class(tree, path):
+    """Name of the node class a candidate reduces, for server statistics"""
+
+    for i in range(len(path), 0, -1):
+        node = getattr_path(tree, path[:i])
+        if isinstance(node, pglast.ast.Node):
+            return type(node).__name__
+    return 'bulk' if path == [] else 'RawStmt'
+
+def check_candidate(state, parsetree2, query, error):
+    """Compare the result of running a candidate with the expected error, and
+    make it the new best parse tree if it matches. With state.confirm set, the
+    query is run that many more times before it is accepted, and rejected if
+    any of these runs yields a different result. Returns True when successful."""
 
-    error = run_query(state, query)
     # if running the reduced query yields a different result, stop recursion here
-    if error != state['expected_error']:
-        if state['verbose']:
-            if state['terminal']:
+    if error != state.expected_error:
+        if state.verbose:
+            if state.terminal:
                 print(" \033[31m✘\033[0m", error)
             else:
                 print(" ✘", error)
-            if state['debug']: print()
+            if state.debug: print()
         return False
 
+    for i in range(state.confirm):
+        state.confirmations += 1
+        error = run_query(state, query)
+        if error != state.expected_error:
+            state.confirm_failures += 1
+            if state.verbose:
+                if state.terminal:
+                    print(" \033[33m✘\033[0m flaky:", error)
+                else:
+                    print(" ✘ flaky:", error)
+                if state.debug: print()
+            return False
+
     # found expected result
-    if state['verbose']:
-        if state['terminal']:
+    if state.verbose:
+        if state.terminal:
             print(" \033[32m✔\033[0m")
         else:
             print(" ✔")
-        if state['debug']: print()
+        if state.debug: print()
 
-    state['parsetree'] = parsetree2
+    state.parsetree = parsetree2
+    if state.progress:
+        state.progress(CachedStream(state.text_cache)(parsetree2))
+    if state.guided:
+        position.locate(state, query)
 
     return True
 
+def try_reduce(state, path, node):
+    """In the currently best parse tree, replace path by given node and run query.
+    Returns True when successful."""
+
+    candidate = prepare_candidate(state, path, node)
+    if candidate is None:
+        return False
+    parsetree2, query = candidate
+    if state.verbose:
+        print(query, end='')
+
+    error = run_query(state, query)
+    return check_candidate(state, parsetree2, query, error)
+
 """
 rules_yaml: what to do when visiting a node type
 
@@ -972,6 +1188,10 @@ VariableShowStmt:
 
 rules = yaml.safe_load(rules_yaml)
 
+def null_node():
+    """Return a fresh NULL constant node"""
+    return pglast.ast.Null() if hasattr(pglast.ast, 'Null') else pglast.ast.A_Const(isnull=True) # pglast 3.9 vs 5.0
+
 def enumerate_paths(node, path=[]):
     """For a node, recursively enumerate all subpaths that are reduction targets"""
 
@@ -985,6 +1205,8 @@ def enumerate_paths(node, path=[]):
 
     if isinstance(node, tuple):
         for i in range(len(node)):
+            if node[i] is None: # SELECT DISTINCT has distinctClause=(None,)
+                continue
             for p in enumerate_paths(node[i], path+[i]): yield p
 
     elif classname in rules:
@@ -1014,17 +1236,18 @@ def enumerate_paths(node, path=[]):
             assert len(node.functions[i]) == 2
             for p in enumerate_paths(node.functions[i][0], path+['functions', i, 0]): yield p
 
-def reduce_step(state, path):
-    """Given a parse tree and a path, try to reduce the node at that path"""
+def reduce_candidates(state, path):
+    """Given a parse tree and a path, yield (path, node) pairs of possible
+    reductions of the node at that path"""
 
-    node = getattr_path(state['parsetree'], path)
+    node = getattr_path(state.parsetree, path)
     classname = type(node).__name__
 
     # we are looking at a tuple, try removing one tuple element
     if isinstance(node, tuple):
         if len(node) > 1: # don't remove the only element
             for i in range(len(node)):
-                if try_reduce(state, path, node[:i] + node[i+1:]): return True
+                yield path, node[:i] + node[i+1:]
 
     # we are looking at a class mentioned in rules_yaml
     elif classname in rules:
@@ -1037,18 +1260,17 @@ def reduce_step(state, path):
                 if subnode := getattr(node, attr):
                     # leave top list of RawStmt in place
                     assert path[1] == 'stmt'
-                    if try_reduce(state, path[:2], subnode): return True
+                    yield path[:2], subnode
 
         # try replacing the node with NULL
         if 'try_null' in rule:
-            null = pglast.ast.Null() if hasattr(pglast.ast, 'Null') else pglast.ast.A_Const(isnull=True) # pglast 3.9 vs 5.0
-            if try_reduce(state, path, null): return True
+            yield path, null_node()
 
         # try removing some attribute
         if 'remove' in rule:
             for attr in rule['remove']:
-                if getattr_path(state['parsetree'], path+[attr]) is not None:
-                    if try_reduce(state, path+[attr], None): return True
+                if getattr_path(state.parsetree, path+[attr]) is not None:
+                    yield path+[attr], None
 
         # try pulling up subexpressions
         if 'pullup' in rule:
@@ -1057,15 +1279,15 @@ def reduce_step(state, path):
                     # if subnode is a tuple, pull up individual elements
                     if isinstance(subnode, tuple):
                         for subnodeelement in subnode:
-                            if try_reduce(state, path, subnodeelement): return True
+                            yield path, subnodeelement
                     else:
-                        if try_reduce(state, path, subnode): return True
+                        yield path, subnode
 
     else:
         print("reduce_step: don't know what to do with the node at path", path)
         print(node)
         print("Please submit this as a bug report")
-        if state['debug']:
+        if state.debug:
             raise Exception("reduce_step: don't know what to do with the node at path " + str(path))
 
     # additional actions
@@ -1073,18 +1295,115 @@ def reduce_step(state, path):
     # case when foo then bar -> foo, bar
     if isinstance(node, pglast.ast.CaseExpr):
         for arg in node.args:
-            if try_reduce(state, path, arg.expr): return True
-            if try_reduce(state, path, arg.result): return True
+            yield path, arg.expr
+            yield path, arg.result
 
     # a JOIN b ON foo -> (SELECT foo) AS sub
     elif isinstance(node, pglast.ast.JoinExpr) and node.quals:
         subselect = pglast.ast.RangeSubselect(subquery=pglast.ast.SelectStmt(targetList=(node.quals,)),
                                               alias=pglast.ast.Alias('sub'))
-        if try_reduce(state, path, subselect): return True
+        yield path, subselect
 
     # ON CONFLICT DO UPDATE -> DO NOTHING
     elif isinstance(node, pglast.ast.OnConflictClause) and node.action == 2: # OnConflictAction.ONCONFLICT_UPDATE: 2
-        if try_reduce(state, path+['action'], 1): return True
+        yield path+['action'], 1
+
+def reduce_step(state, path):
+    """Given a parse tree and a path, try to reduce the node at that path"""
+
+    if state.knowledge is not None:
+        return state.knowledge.reduce_step(state, path, reduce_candidates(state, path))
+    for path2, node in reduce_candidates(state, path):
+        if try_reduce(state, path2, node): return True
+
+"""
+bulk_actions: reduction steps applied to all matching nodes at once
+
+Before the main loop starts, bulk_reduce() tries each of these actions on all
+matching nodes of the parse tree in a single query. If that does not yield
+the expected error, the set of nodes is bisected and both halves are tried
+separately. On large queries, this replaces hundreds of single-node attempts by
+a handful of bulk attempts; whatever could not be reduced in bulk is left for
+reduce_loop() to look at.
+
+Each entry is (classname, action, attr):
+    * try_null: replace the node with NULL
+    * pullup: replace the node with its attribute attr
+    * remove: set attribute attr to None
+"""
+
+bulk_actions = [
+    ('A_Const', 'try_null', None),  # NULL every constant
+    ('TypeCast', 'pullup', 'arg'),  # strip every cast
+    ('ResTarget', 'remove', 'name'),  # remove every column alias
+]
+
+def bulk_node(tree, path, classname, action, attr):
+    """Return the node that replaces the node at path in tree, or None if the
+    action is not applicable (anymore)"""
+
+    # the path might have vanished or changed meaning by an earlier reduction
+    if classname_at(tree, path) != classname:
+        return None
+    node = getattr_path(tree, path)
+
+    if action == 'try_null':
+        if isinstance(node, pglast.ast.A_Const) and node.isnull:
+            return None
+        return null_node()
+
+    elif action == 'pullup':
+        return getattr(node, attr)
+
+    elif action == 'remove':
+        if getattr(node, attr) is None:
+            return None
+        # ResTarget.name is the target column in UPDATE and INSERT, only touch SELECT
+        if classname_at(tree, path[:-2]) != 'SelectStmt':
+            return None
+        node = copy_node(node)
+        setattr(node, attr, None)
+        return node
+
+def classname_at(tree, path):
+    try:
+        return type(getattr_path(tree, path)).__name__
+    except (AttributeError, IndexError, TypeError):
+        return None
+
+def bulk_try(state, paths, classname, action, attr):
+    """Apply action on all paths at once, bisect on failure"""
+
+    tree = state.parsetree
+    changed = False
+    # process paths in reverse pre-order so nested nodes are replaced before their parents
+    for path in reversed(paths):
+        node = bulk_node(tree, path, classname, action, attr)
+        if node is None:
+            continue
+        tree = setattr_path(tree, path, node)
+        changed = True
+    if not changed:
+        return
+
+    if try_reduce(state, [], tree):
+        return
+    if len(paths) == 1:
+        return
+
+    half = len(paths) // 2
+    bulk_try(state, paths[:half], classname, action, attr)
+    bulk_try(state, paths[half:], classname, action, attr)
+
+def bulk_reduce(state):
+    """Try reducing all nodes of a kind at once"""
+
+    for classname, action, attr in bulk_actions:
+        paths = [path for path in enumerate_paths(state.parsetree)
+                 if classname_at(state.parsetree, path) == classname]
+        # single nodes are handled by reduce_loop
+        if len(paths) > 1:
+            bulk_try(state, paths, classname, action, attr)
 
 def reduce_loop(state):
     """Try running reduce steps until no reduction is found"""
@@ -1093,61 +1412,513 @@ def reduce_loop(state):
     while found:
         found = False
 
+        # the knowledge base orders candidates itself
+        if state.error_path is not None and state.knowledge is None:
+            found = any(try_reduce(state, path, node) for path, node in all_candidates(state))
+            continue
+
         # enumerate all places that might be reduced, and try running a step on them
-        for path in enumerate_paths(state['parsetree']):
+        for path in enumerate_paths(state.parsetree):
             if reduce_step(state, path):
                 found = True
                 break
 
-def run_reduce(query, database='', verbose=False, use_sqlstate=False, timeout='500ms', debug=False):
-    """Set up state object for running reduce steps"""
-
-    # parse query
-    parsed_query = pglast.parse_sql(query)
-    parsetree = parsed_query
-    regenerated_query = RawStream()(parsetree)
-
-    state = {
-            'called': 0,
-            'database': database,
-            'debug': debug,
-            'parsetree': parsetree,
-            'regenerated_query': regenerated_query,
-            'seen': set(),
-            'terminal': sys.stdout.isatty() and os.environ.get('TERM') != 'dumb',
-            'timeout': timeout,
-            'use_sqlstate': use_sqlstate,
-            'verbose': verbose,
-            }
-
-    state['expected_error'] = run_query(state, query)
-
-    if verbose:
-        print("Input query:", query)
-        print("Regenerated:", regenerated_query)
-        print("Query returns:", end=' ')
-        if state['terminal']:
-            print(f"\033[32m✔\033[0m \033[1m{state['expected_error']}\033[0m")
+def all_candidates(state):
+    """Enumerate all possible reductions of the current parse tree. With the
+    error node known, the ones far from it come first."""
+
+    if state.error_path is not None:
+        yield from position.ordered_candidates(state)
+        return
+    for path in enumerate_paths(state.parsetree):
+        for path2, node in reduce_candidates(state, path): yield path2, node
+
+def disjoint(path1, path2):
+    """Check that neither path is a prefix of the other"""
+    n = min(len(path1), len(path2))
+    return path1[:n] != path2[:n]
+
+def merge_candidates(state, tree, successes):
+    """Given a list of (path, node) reductions of tree that each yield the
+    expected error, try applying all reductions on disjoint paths at once.
+    The first one has already been accepted; if the combination does not
+    yield the expected error, the parse tree is left at that."""
+
+    merged = successes[:1]
+    for path, node in successes[1:]:
+        if all(disjoint(path, path2) for path2, node2 in merged):
+            merged.append((path, node))
+    if len(merged) < 2:
+        return False
+
+    for path, node in merged:
+        tree = setattr_path(tree, path, node)
+    return try_reduce(state, [], tree)
+
+def run_batch(state, batch):
+    """Run a batch of prepared candidates in one round trip and accept the first
+    one that yields the expected error. Later candidates of the batch that
+    yield the expected error as well are merged into the result if they
+    touch different parts of the tree. Returns True when successful."""
+
+    tree = state.parsetree
+    # pipelined results don't carry error positions
+    state.error_position = None
+    errors = run_queries_pipelined(state, [query for path, node, parsetree2, query in batch])
+    successes = []
+    accepted = None
+    for i, ((path, node, parsetree2, query), error) in enumerate(zip(batch, errors)):
+        if successes:
+            # collect more successful reductions of the old parse tree
+            if error == state.expected_error:
+                successes.append((path, node))
+            continue
+        if state.verbose:
+            print(query, end='')
+        # the connection was lost during the batch, run this candidate on its own
+        if error is None:
+            error = run_query(state, query)
+        if check_candidate(state, parsetree2, query, error):
+            successes.append((path, node))
+            accepted = i
+
+    if not successes:
+        return False
+    # later candidates were built from the old parse tree, forget them
+    for path, node, parsetree2, query in batch[accepted+1:]:
+        state.seen.discard(query)
+        state.seen_hashes.discard(node_hash(parsetree2, state.hash_cache))
+    merge_candidates(state, tree, successes)
+    return True
+
+def reduce_loop_pipelined(state):
+    """Like reduce_loop(), but run candidates in batches of state.pipeline queries.
+    The first successful candidate of a batch wins, just as if the candidates
+    had been run one at a time."""
+
+    found = True
+    while found:
+        found = False
+        batch = []
+        for path, node in all_candidates(state):
+            if candidate := prepare_candidate(state, path, node):
+                batch.append((path, node) + candidate)
+            if len(batch) >= state.pipeline:
+                if run_batch(state, batch):
+                    found = True
+                    break
+                batch = []
         else:
-            print("✔", state['expected_error'])
-        if state['debug']:
-            print("Parse tree:", state['parsetree'])
-        print()
-
-    state['seen'].add(regenerated_query)
-    regenerated_query_error = run_query(state, regenerated_query)
-    if state['expected_error'] != regenerated_query_error:
-        print("The original query and the parsed and regenerated query do not return the same result state.")
-        print("The query is either not stable, or we have found a parser/generator bug.")
-        print("We'll proceed anyway, but the result is probably bogus.")
-        print("Regenerated query returns:", regenerated_query_error)
-        print()
-        if state['debug']:
-            raise Exception("The original query and the parsed and regenerated query do not return the same result state.")
-
-    reduce_loop(state)
-
-    return RawStream()(state['parsetree']), state
+            if batch and run_batch(state, batch):
+                found = True
+
+def pipeline_usable(state):
+    """Check if candidates can be run in pipeline mode"""
+
+    if not pipeline_available():
+        print("Pipeline mode requires psycopg 3 with libpq 14 or later, running queries one at a time")
+        return False
+    # crashes take down the connection and need a server restart anyway
+    if state.expected_crash or state.oracle is not None:
+        return False
+    # the guard's settings and plan checks are only applied by run_query()
+    if state.guard is not None:
+        if state.verbose:
+            print("Pipeline mode does not support the resource guard, running queries one at a time")
+            print()
+        return False
+    # pipeline mode can't do multiple statements per query, COPY, or transaction control
+    if len(state.parsetree) > 1 or \
+            isinstance(state.parsetree[0].stmt, (pglast.ast.CopyStmt, pglast.ast.TransactionStmt)):
+        return False
+    # make sure the query behaves the same as when run with psycopg2
+    if run_queries_pipelined(state, [state.regenerated_query]) != [state.expected_error]:
+        if state.verbose:
+            print("Regenerated query yields a different result in pipeline mode, running queries one at a time")
+            print()
+        return False
+    return True
+
+def parallel_usable(state):
+    """Check if parts of the query can be reduced in parallel"""
+
+    # each crash restarts the server and aborts the queries of all workers
+    if state.expected_crash:
+        if state.verbose:
+            print("The query crashes the server, running queries one at a time")
+            print()
+        return False
+    # oracles keep per-reduction state and measurements would disturb each other
+    if state.oracle is not None:
+        return False
+    return True
+
+class Reducer:
+    """Reduce queries against a database
+
+    A Reducer holds the settings and the database connections for reducing
+    queries, and the state of the current reduction. It can be reused for
+    reducing many queries in a row; connections are kept open between queries.
+    Instances must not be shared between threads, use one Reducer per thread
+    (only cancel() may be called from a different thread).
+
+    >>> reducer = Reducer(database='dbname=regression', timeout='1s')
+    >>> reducer.reduce('select 1, moo, 3')
+    'SELECT moo'
+
+    With max_time (seconds) or max_queries set, reduce() stops when the budget
+    runs out and returns the smallest query found so far; budget_exhausted is
+    set in that case. progress, if set, is called with the new best query
+    whenever a reduction step succeeds.
+
+    By default, a candidate reproduces the problem if it yields the same error
+    as the original query. An oracle object can define a different outcome:
+    its run(state, query) method is called instead of running the query, and
+    candidates are accepted when it returns the same outcome as for the
+    original query (see sqlreduce.compare for an example).
+
+    With server_stats set, server-side time spent on the reduction is read from
+    pg_stat_statements and reported per candidate class in stats_report (see
+    sqlreduce.stats).
+
+    knowledge can be a sqlreduce.knowledge.KnowledgeBase that orders candidates
+    by their outcomes in earlier reductions.
+
+    For queries with non-deterministic results, confirm sets how many more times
+    a candidate is run before it is accepted; candidates are still run only once
+    when they don't match. The input query is also run confirm more times, and
+    flaky_input is set to the list of its results if they differ.
+
+    guard can be a sqlreduce.guard.Guard profile limiting the resources
+    candidates may use; guard trips are counted in guard_trips.
+
+    Queries running longer than hang_timeout seconds (despite the statement
+    timeout) are interrupted by a watchdog thread and yield the outcome 'hang'
+    (see sqlreduce.watchdog). The default 'auto' is the statement timeout plus
+    a minute; set it to None to disable the watchdog.
+
+    With jobs > 1, disjoint parts of the query are first reduced in parallel on
+    that many connections (see sqlreduce.parallel).
+
+    With prefetch > 0, up to that many candidates are prepared in a separate
+    thread while the current one runs (see sqlreduce.prefetch).
+
+    With tune set, cost-reducing session settings (jit=off etc.) that keep the
+    outcome of the input query are used for all candidates; the chosen ones
+    are stored in session_settings (see sqlreduce.tuning).
+
+    Reducers working on the same server can share a lock in crash_lock; the
+    reduction of queries crashing the server holds it, so only one of them
+    restarts the server at a time (see sqlreduce.serve).
+
+    With guided set, the node at the position PostgreSQL reports for the error
+    is stored in error_path, and candidates far from it are tried first (see
+    sqlreduce.position).
+
+    With prune set (the default), candidates that remove a table, alias or CTE
+    still referenced elsewhere in the query are not run, unless the expected
+    error is itself about unknown names; they are counted in pruned (see
+    sqlreduce.semantic).
+    """
+
+    __slots__ = (
+            # settings
+            'bulk',
+            'confirm',
+            'crash_lock',
+            'database',
+            'debug',
+            'guard',
+            'guided',
+            'hang_timeout',
+            'jobs',
+            'knowledge',
+            'max_queries',
+            'max_time',
+            'oracle',
+            'pipeline',
+            'prefetch',
+            'progress',
+            'prune',
+            'reconnect',
+            'server_stats',
+            'terminal',
+            'timeout',
+            'tune',
+            'use_sqlstate',
+            'verbose',
+            # connections
+            'conn',
+            'pipeline_conn',
+            'reference_conn',
+            'watchdog',
+            # state of the current reduction
+            'budget_exhausted',
+            'called',
+            'cancelled',
+            'confirm_failures',
+            'confirmations',
+            'crashed',
+            'deadline',
+            'duplicates',
+            'error_path',
+            'error_position',
+            'error_position_bytes',
+            'expected_crash',
+            'expected_error',
+            'flaky_input',
+            'guard_trips',
+            'hangs',
+            'hash_cache',
+            'parsetree',
+            'pruned',
+            'pruning',
+            'regenerated_query',
+            'seen',
+            'seen_hashes',
+            'semantic_index',
+            'session_settings',
+            'stat_classes',
+            'stats_report',
+            'text_cache',
+            'workers',
+            )
+
+    def __init__(self, database='', verbose=False, use_sqlstate=False, timeout='500ms', debug=False, bulk=False, pipeline=0, reconnect=False,
+            max_time=None, max_queries=None, progress=None, oracle=None, server_stats=False, knowledge=None, confirm=0, guard=None, hang_timeout='auto', jobs=1, tune=False, prefetch=0, prune=True, guided=False):
+        self.bulk = bulk
+        self.confirm = confirm
+        self.database = database
+        self.debug = debug
+        self.guard = guard
+        self.guided = guided
+        self.hang_timeout = default_hang_timeout(timeout) if hang_timeout == 'auto' else hang_timeout
+        self.jobs = jobs
+        self.knowledge = knowledge
+        self.max_queries = max_queries
+        self.max_time = max_time
+        self.oracle = oracle
+        self.pipeline = pipeline
+        self.prefetch = prefetch
+        self.progress = progress
+        self.prune = prune
+        self.reconnect = reconnect
+        self.server_stats = server_stats
+        self.terminal = sys.stdout.isatty() and os.environ.get('TERM') != 'dumb'
+        self.timeout = timeout
+        self.tune = tune
+        self.use_sqlstate = use_sqlstate
+        self.verbose = verbose
+
+        self.conn = None
+        self.pipeline_conn = None
+        self.reference_conn = None
+        self.watchdog = None
+        self.cancelled = False
+        self.crash_lock = None
+        self.crashed = False
+        self.hangs = 0
+        self.deadline = None
+        self.error_path = None
+        self.error_position = None
+        self.error_position_bytes = False
+        self.pruning = False
+        self.semantic_index = None
+        self.session_settings = []
+        self.stat_classes = None
+        self.stats_report = None
+        self.workers = []
+
+    def cancel(self):
+        """Cancel the running reduction from a different thread. reduce() will
+        raise Cancelled; set cancelled = False before reusing the Reducer."""
+
+        self.cancelled = True
+        for worker in self.workers:
+            worker.cancel()
+        for conn in (self.conn, self.reference_conn):
+            if conn:
+                try:
+                    conn.cancel()
+                except Exception:
+                    pass
+
+    def close(self):
+        """Close database connections"""
+
+        for conn in (self.conn, self.pipeline_conn, self.reference_conn):
+            if conn:
+                conn.close()
+        self.conn = None
+        self.pipeline_conn = None
+        self.reference_conn = None
+        if self.watchdog:
+            self.watchdog.close()
+            self.watchdog = None
+
+    def reduce(self, query):
+        """Reduce query, returns the minimal query"""
+
+        # parse query
+        parsed_query = pglast.parse_sql(query)
+        parsetree = parsed_query
+        regenerated_query = RawStream()(parsetree)
+
+        self.budget_exhausted = False
+        self.called = 0
+        self.confirm_failures = 0
+        self.confirmations = 0
+        self.deadline = time.time() + self.max_time if self.max_time is not None else None
+        self.duplicates = 0
+        self.error_path = None
+        self.guard_trips = 0
+        self.hangs = 0
+        self.hash_cache = {}
+        self.parsetree = parsetree
+        self.pruned = 0
+        self.pruning = False
+        self.regenerated_query = regenerated_query
+        self.seen = set()
+        self.seen_hashes = set()
+        self.semantic_index = None
+        self.text_cache = {}
+
+        # settings chosen for the previous query
+        if self.session_settings:
+            tuning.use_settings(self, [])
+
+        start_watchdog(self)
+        if self.guard is not None and (dropped := self.guard.check(self.database)):
+            print("Resource guard settings not used because the user can't set them:", ', '.join(dropped))
+            print()
+        before = None
+        if self.server_stats:
+            before = self.stats_snapshot()
+            self.stat_classes = {stats.query_fingerprint(query): 'input'}
+
+        self.expected_error = run_query(self, query)
+        self.expected_crash = self.crashed
+        if self.guided:
+            position.locate(self, query, parsed_query)
+        if self.expected_error.startswith(guard_prefix):
+            print("The input query trips the resource guard, raise its limits or disable it:", self.expected_error)
+            print()
+
+        # other reductions on the same server would see the restarts as errors
+        if self.expected_crash and self.crash_lock is not None:
+            with self.crash_lock:
+                return self.reduce_expected(query, before)
+        return self.reduce_expected(query, before)
+
+    def reduce_expected(self, query, before):
+        """Reduce the parse tree of query once its expected error is known.
+        before is the statistics snapshot taken before running query."""
+
+        # a crash needs a server restart anyway, don't add more of them
+        if self.tune and not self.expected_crash:
+            rejected = tuning.choose_settings(self, query)
+            if self.verbose:
+                print("Session settings:", tuning.options(self.session_settings) or "(defaults)")
+                if rejected:
+                    print("Not used because the result changes:", tuning.options(rejected))
+
+        # detect flaky input before spending time on reducing it
+        results = [self.expected_error] + [run_query(self, query) for i in range(self.confirm)]
+        self.flaky_input = results if len(set(results)) > 1 else None
+        if self.flaky_input:
+            print("The input query does not return the same result every time:")
+            for result in sorted(set(results)):
+                print(f"    {results.count(result)}x {result}")
+            print("Reducing to the first result, candidates are confirmed by running them", self.confirm, "more times.")
+            print()
+        if self.knowledge is not None:
+            self.knowledge.start(self.expected_error)
+        # an oracle might accept queries that don't even run
+        self.pruning = self.prune and self.oracle is None and not semantic.reference_error(self.expected_error)
+
+        if self.verbose:
+            print("Input query:", query)
+            print("Regenerated:", self.regenerated_query)
+            print("Query returns:", end=' ')
+            if self.terminal:
+                print(f"\033[32m✔\033[0m \033[1m{self.expected_error}\033[0m")
+            else:
+                print("✔", self.expected_error)
+            if self.debug:
+                print("Parse tree:", self.parsetree)
+            print()
+
+        self.seen.add(self.regenerated_query)
+        self.seen_hashes.add(node_hash(self.parsetree, self.hash_cache))
+        regenerated_query_error = run_query(self, self.regenerated_query)
+        if self.guided and self.error_path is None and regenerated_query_error == self.expected_error:
+            position.locate(self, self.regenerated_query)
+        if self.expected_error != regenerated_query_error:
+            print("The original query and the parsed and regenerated query do not return the same result state.")
+            print("The query is either not stable, or we have found a parser/generator bug.")
+            print("We'll proceed anyway, but the result is probably bogus.")
+            print("Regenerated query returns:", regenerated_query_error)
+            print()
+            if self.debug:
+                raise Exception("The original query and the parsed and regenerated query do not return the same result state.")
+
+        try:
+            if self.bulk:
+                bulk_reduce(self)
+            if self.jobs > 1 and parallel_usable(self):
+                from sqlreduce.parallel import reduce_parallel
+                reduce_parallel(self)
+            if self.pipeline > 1 and pipeline_usable(self):
+                reduce_loop_pipelined(self)
+            # the knowledge base orders candidates itself, and debug output would be interleaved
+            elif self.prefetch > 0 and self.knowledge is None and not self.debug:
+                from sqlreduce.prefetch import reduce_loop_prefetch
+                reduce_loop_prefetch(self)
+            else:
+                reduce_loop(self)
+            # the knowledge base skipped some candidates, verify we are at a fixpoint
+            if self.knowledge is not None and self.knowledge.stats['skipped']:
+                self.knowledge.skipping = False
+                reduce_loop(self)
+        except BudgetExhausted:
+            self.budget_exhausted = True
+            if self.verbose:
+                print()
+                print("Budget exhausted, stopping with the best query found so far")
+
+        if self.knowledge is not None:
+            self.knowledge.save()
+
+        if self.server_stats:
+            after = self.stats_snapshot()
+            if before and after:
+                self.stats_report = stats.report(before, after, self.stat_classes)
+            self.stat_classes = None
+
+        return RawStream()(self.parsetree)
+
+    def stats_snapshot(self):
+        # make our backend report its pending statistics (PostgreSQL 15+)
+        run_in_transaction(self, 'conn', self.database, lambda cur: cur.execute("select pg_stat_force_next_flush()"))
+        error, snapshot = run_in_transaction(self, 'conn', self.database, stats.snapshot)
+        if error != 'no error':
+            print("Could not read server statistics:", error)
+        return snapshot
+
+def run_reduce(query, database='', verbose=False, use_sqlstate=False, timeout='500ms', debug=False, bulk=False, pipeline=0, reconnect=False,
+        max_time=None, max_queries=None, progress=None, oracle=None, server_stats=False, knowledge=None, confirm=0, guard=None, hang_timeout='auto', jobs=1, tune=False, prefetch=0, prune=True, guided=False):
+    """Reduce a single query, returns the minimal query and the Reducer object
+    holding the reduction state"""
+
+    reducer = Reducer(database=database, verbose=verbose, use_sqlstate=use_sqlstate,
+            timeout=timeout, debug=debug, bulk=bulk, pipeline=pipeline, reconnect=reconnect,
+            max_time=max_time, max_queries=max_queries, progress=progress, oracle=oracle,
+            server_stats=server_stats, knowledge=knowledge, confirm=confirm, guard=guard,
+            hang_timeout=hang_timeout, jobs=jobs, tune=tune, prefetch=prefetch, prune=prune, guided=guided)
+    try:
+        return reducer.reduce(query), reducer
+    finally:
+        reducer.close()
 
 if __name__ == "__main__":
     print(run_reduce("select 1, moo, 3"))
@@ -0,0 +1,180 @@
+"""
+Synthetic scaling benchmark for the reduction algorithm
+
+The reduction is O(Nodes²) in theory (see rules_yaml), and fast in practice
+because whole subtrees go away early. To see how it actually scales, and to
+catch algorithmic regressions before they show up on real queries, generate()
+builds queries of a given size and shape:
+
+    SELECT f(f(c0, c1), f(c2, essential_0)), f(f(c4, c5), f(c6, c7)), ...
+
+Each target list entry is a tree of function calls with the given depth and
+fan-out; the leaves are column references. Some leaves are "essential": the
+SyntheticOracle says the problem reproduces as long as the query still mentions
+all (or any) of them, so no database is needed and the minimal query is known:
+SELECT essential_0, essential_1, ...
+
+run_benchmark() reduces queries of growing size and reports oracle calls, CPU
+time spent in enumerate_paths(), setattr_path() and query rendering, and
+optionally the peak memory; fit_exponent() estimates k in time ~ nodes^k.
+"""
+
+import argparse
+import cProfile
+import csv
+import math
+import pstats
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+import pglast
+
+import sqlreduce
+
+placements = ('first', 'last', 'spread', 'random')
+
+# functions whose cumulative CPU time is reported, by (file suffix, name)
+profiled = {
+    'enumerate_paths': ('sqlreduce/__init__.py', 'enumerate_paths'),
+    'setattr_path': ('sqlreduce/__init__.py', 'setattr_path'),
+    'render': ('sqlreduce/stream.py', '__call__'),
+}
+
+class SyntheticOracle:
+    """Oracle reproducing the problem while essential leaves are present"""
+
+    def __init__(self, essential, mode='all', latency=0):
+        self.essential = {f"essential_{i}" for i in range(essential)}
+        self.mode = mode
+        self.latency = latency
+
+    def run(self, state, query):
+        if self.latency:
+            time.sleep(self.latency)
+        present = self.essential & set(re.findall(r'\bessential_\d+\b', query))
+        if self.mode == 'all':
+            return 'reproduces' if present == self.essential else 'gone'
+        return 'reproduces' if present else 'gone'
+
+def essential_leaves(leaves, essential, placement, rng):
+    """Indexes of the essential leaves"""
+
+    essential = min(essential, leaves)
+    if placement == 'first':
+        return set(range(essential))
+    if placement == 'last':
+        return set(range(leaves - essential, leaves))
+    if placement == 'spread':
+        return {i * leaves // essential + leaves // (2 * essential) for i in range(essential)}
+    return set(rng.sample(range(leaves), essential))
+
+def generate(nodes, depth=3, fanout=2, essential=1, placement='spread', seed=0):
+    """Return a query with about nodes reduction targets"""
+
+    # each target list entry has a function call tree with fanout^depth leaves;
+    # function calls count twice (the call and its argument list)
+    per_target = 2 * sum(fanout ** level for level in range(depth)) + fanout ** depth + 1
+    targets = max(1, round(nodes / per_target))
+    leaves = targets * fanout ** depth
+    marked = essential_leaves(leaves, essential, placement, random.Random(seed))
+    counter = iter(range(leaves))
+    names = iter(range(essential))
+
+    def tree(level):
+        if level == depth:
+            i = next(counter)
+            return f"essential_{next(names)}" if i in marked else f"c{i}"
+        return 'f(' + ', '.join(tree(level + 1) for i in range(fanout)) + ')'
+
+    return 'select ' + ', '.join(tree(0) for i in range(targets))
+
+def count_nodes(query):
+    return sum(1 for path in sqlreduce.enumerate_paths(pglast.parse_sql(query)))
+
+def profiled_times(profile):
+    """Cumulative time of the profiled functions"""
+
+    times = dict.fromkeys(profiled, 0.0)
+    for (filename, line, function), (cc, nc, tt, ct, callers) in pstats.Stats(profile).stats.items():
+        for key, (suffix, name) in profiled.items():
+            if function == name and filename.endswith(suffix):
+                times[key] += ct
+    return times
+
+def run_benchmark(sizes, depth=3, fanout=2, essential=1, placement='spread', mode='all', latency=0, memory=False, seed=0):
+    """Reduce synthetic queries of the given sizes, returns a list of result rows"""
+
+    rows = []
+    for size in sizes:
+        query = generate(size, depth, fanout, essential, placement, seed)
+        reducer = sqlreduce.Reducer(oracle=SyntheticOracle(essential, mode, latency), hang_timeout=None)
+        profile = cProfile.Profile()
+        if memory:
+            tracemalloc.start()
+        start, cpu_start = time.time(), time.process_time()
+        profile.enable()
+        try:
+            result = reducer.reduce(query)
+        finally:
+            profile.disable()
+            reducer.close()
+        row = {
+            'nodes': count_nodes(query),
+            'depth': depth,
+            'fanout': fanout,
+            'queries': len(reducer.seen),
+            'candidates': reducer.called,
+            'wall': time.time() - start,
+            'cpu': time.process_time() - cpu_start,
+        }
+        row.update(profiled_times(profile))
+        if memory:
+            row['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        row['result_nodes'] = count_nodes(result)
+        rows.append(row)
+    return rows
+
+def fit_exponent(rows, key):
+    """Least squares fit of log(rows[key]) over log(nodes), i.e. k in key ~ nodes^k"""
+
+    points = [(math.log(row['nodes']), math.log(row[key])) for row in rows if row[key] > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    var = sum((x - mean_x) ** 2 for x, y in points)
+    if var == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+def bench_main(argv):
+    argparser = argparse.ArgumentParser(prog="sqlreduce bench",
+            description="Measure how the reduction scales on synthetic queries, no database needed")
+    argparser.add_argument("--sizes", default='100,200,400,800,1600', help="Comma-separated list of approximate node counts [Default: 100,200,400,800,1600]")
+    argparser.add_argument("--depth", type=int, default=3, help="Depth of function call trees [Default: 3]")
+    argparser.add_argument("--fanout", type=int, default=2, help="Arguments per function call [Default: 2]")
+    argparser.add_argument("--essential", type=int, default=1, help="Number of leaves the oracle needs [Default: 1]")
+    argparser.add_argument("--placement", choices=placements, default='spread', help="Position of the essential leaves [Default: spread]")
+    argparser.add_argument("--mode", choices=('all', 'any'), default='all', help="Reproduce while all or any essential leaves are present [Default: all]")
+    argparser.add_argument("--latency", type=float, default=0, metavar='SECONDS', help="Simulated time per oracle call [Default: 0]")
+    argparser.add_argument("--memory", action='store_true', help="Measure peak memory (slows down the run)")
+    argparser.add_argument("--seed", type=int, default=0, help="Seed for random placement [Default: 0]")
+    args = argparser.parse_args(argv)
+
+    rows = run_benchmark([int(size) for size in args.sizes.split(',')], args.depth, args.fanout, args.essential,
+            args.placement, args.mode, args.latency, args.memory, args.seed)
+
+    writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({key: f"{value:.4f}" if isinstance(value, float) else value for key, value in row.items()})
+
+    print()
+    print("Scaling exponents (value ~ nodes^k):")
+    for key in ('queries', 'cpu') + tuple(profiled) + (('peak_memory',) if args.memory else ()):
+        k = fit_exponent(rows, key)
+        print(f"    {key:<16} {'n/a' if k is None else f'{k:.2f}'}")
@@ -0,0 +1,139 @@
+"""
+Managed throwaway cluster for crash reductions
+
+When reducing crashes, most of the runtime is spent waiting for the postmaster
+to restart after each crashing candidate. Shared development clusters are set
+up for durability, so crash recovery has to replay and sync WAL. A managed
+cluster is created for the reduction only, and removed afterwards:
+
+    * initdb runs once per PostgreSQL installation and schema file; the data
+      directory is cached as template and copied for each run
+    * the schema (e.g. a dump of the regression database) is loaded into the
+      template, so loading it is not repeated either
+    * the server runs with fsync off, minimal WAL, small shared_buffers and no
+      autovacuum, which keeps crash recovery short
+    * it only listens on a Unix socket in its own directory, so it doesn't get
+      in the way of other servers
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+# server settings tuned for fast restarts after crashes
+settings = {
+    'fsync': 'off',
+    'synchronous_commit': 'off',
+    'full_page_writes': 'off',
+    'wal_level': 'minimal',
+    'max_wal_senders': '0',
+    'shared_buffers': '16MB',
+    'max_connections': '20',
+    'autovacuum': 'off',
+    'restart_after_crash': 'on',
+    'listen_addresses': "''",
+}
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'sqlreduce')
+
+def find_bindir():
+    """Directory of the PostgreSQL programs: from pg_config, or where initdb is in PATH"""
+
+    pg_config = shutil.which('pg_config')
+    if pg_config:
+        bindir = subprocess.run([pg_config, '--bindir'], capture_output=True, text=True, check=True).stdout.strip()
+        if os.path.exists(os.path.join(bindir, 'initdb')):
+            return bindir
+    initdb = shutil.which('initdb')
+    if initdb:
+        return os.path.dirname(initdb)
+    raise Exception("PostgreSQL programs not found, use --pg-bindir")
+
+class Cluster:
+    """PostgreSQL cluster owned by sqlreduce"""
+
+    def __init__(self, bindir=None, schema=None, cache_dir=None, port=5432):
+        self.bindir = bindir or find_bindir()
+        self.schema = schema
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.port = port
+        self.directory = None
+
+    def run(self, program, *args):
+        subprocess.run([os.path.join(self.bindir, program), *args], check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def options(self, socket_dir):
+        return ' '.join([f"-c port={self.port}", f"-c unix_socket_directories='{socket_dir}'"] +
+                [f"-c {name}={value}" for name, value in settings.items()])
+
+    def template_key(self):
+        """Cache key: PostgreSQL installation and version, and schema file contents"""
+
+        key = hashlib.sha256(self.bindir.encode())
+        key.update(subprocess.run([os.path.join(self.bindir, 'postgres'), '--version'],
+                capture_output=True, text=True, check=True).stdout.encode())
+        if self.schema:
+            with open(self.schema, 'rb') as f:
+                key.update(f.read())
+        return key.hexdigest()[:16]
+
+    def template(self):
+        """Return the template data directory, create it if it's not cached"""
+
+        template = os.path.join(self.cache_dir, 'template-' + self.template_key())
+        if os.path.exists(template):
+            return template
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        building = tempfile.mkdtemp(prefix='template-', dir=self.cache_dir)
+        try:
+            pgdata = os.path.join(building, 'data')
+            self.run('initdb', '-D', pgdata, '--no-sync', '--auth=trust', '--encoding=UTF8', '--locale=C')
+            if self.schema:
+                self.run('pg_ctl', '-D', pgdata, '-w', '-o', self.options(building), '-l', os.path.join(building, 'log'), 'start')
+                try:
+                    self.run('psql', '-X', '-q', '-v', 'ON_ERROR_STOP=1', '-h', building, '-p', str(self.port),
+                            '-d', 'postgres', '-f', self.schema)
+                finally:
+                    self.run('pg_ctl', '-D', pgdata, '-w', '-m', 'fast', 'stop')
+            # another run might have built the same template meanwhile
+            try:
+                os.rename(pgdata, template)
+            except OSError:
+                if not os.path.exists(template):
+                    raise
+        finally:
+            shutil.rmtree(building, ignore_errors=True)
+        return template
+
+    def start(self):
+        """Copy the template and start the server, returns the connection string"""
+
+        template = self.template()
+        self.directory = tempfile.mkdtemp(prefix='sqlreduce-')
+        pgdata = os.path.join(self.directory, 'data')
+        shutil.copytree(template, pgdata)
+        os.chmod(pgdata, 0o700)
+        self.run('pg_ctl', '-D', pgdata, '-w', '-o', self.options(self.directory),
+                '-l', os.path.join(self.directory, 'log'), 'start')
+        return self.dsn
+
+    @property
+    def dsn(self):
+        return f"host={self.directory} port={self.port} dbname=postgres"
+
+    def stop(self):
+        """Stop the server and remove the cluster"""
+
+        if self.directory is None:
+            return
+        try:
+            self.run('pg_ctl', '-D', os.path.join(self.directory, 'data'), '-w', '-m', 'immediate', 'stop')
+        except subprocess.CalledProcessError:
+            pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
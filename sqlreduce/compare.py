@@ -0,0 +1,99 @@
+"""
+Wrong-result oracle: reduce queries whose results differ between two servers
+
+Instead of an error message, the outcome of a candidate is whether its result
+differs between the database being reduced against and a reference database,
+e.g. two PostgreSQL builds, or the same server with different settings passed
+in the connection string's options.
+
+Each candidate runs on both servers at the same time. Rows are never kept in
+memory: SELECT queries are read through a server-side cursor in chunks, and
+each row is folded into an order-insensitive hash (the sum of the rows'
+hashes, modulo 2**64) together with the row count, so results that differ only
+in row order compare equal.
+
+Outcomes:
+    * "results differ": both servers ran the query, with different results
+    * "same results": both servers returned the same result
+    * "<error 1> | <error 2>": at least one server failed; the errors (or
+      'no error') of both servers
+"""
+
+import hashlib
+import threading
+
+import pglast
+from pglast.parser import ParseError
+
+import sqlreduce
+
+# rows fetched per round trip from the server-side cursor
+fetch_size = 10000
+
+def row_hash(row):
+    return int.from_bytes(hashlib.blake2b(repr(row).encode(), digest_size=8).digest(), 'little')
+
+def fold_rows(rows, count, total):
+    for row in rows:
+        count += 1
+        total = (total + row_hash(row)) % 2**64
+    return count, total
+
+def is_select(query):
+    """Check if query is a single statement that can be run from a cursor"""
+
+    try:
+        parsetree = pglast.parse_sql(query)
+    except ParseError:
+        return False
+    return len(parsetree) == 1 and isinstance(parsetree[0].stmt, pglast.ast.SelectStmt)
+
+def result_hash(cur, query, use_cursor):
+    """Run query, returns (row count, hash) of its result"""
+
+    if not use_cursor:
+        cur.execute(query)
+        count, total = 0, 0
+        if cur.description is not None:
+            while rows := cur.fetchmany(fetch_size):
+                count, total = fold_rows(rows, count, total)
+        return count, total
+
+    cur.execute(f"declare sqlreduce_result no scroll cursor for {query}")
+    count, total = 0, 0
+    while True:
+        cur.execute(f"fetch {fetch_size} from sqlreduce_result")
+        rows = cur.fetchall()
+        if not rows:
+            return count, total
+        count, total = fold_rows(rows, count, total)
+
+class CompareOracle:
+    """Run candidates on state.database and a reference database, and compare
+    their results"""
+
+    def __init__(self, reference):
+        self.reference = reference
+
+    def run(self, state, query):
+        use_cursor = is_select(query)
+        func = lambda cur: result_hash(cur, query, use_cursor)
+
+        # both threads use state, the outcomes are recorded afterwards
+        sqlreduce.start_watchdog(state)
+        reference_result = [None]
+        def run_reference():
+            reference_result[0] = sqlreduce.transaction_outcome(state, 'reference_conn', self.reference, func)
+        thread = threading.Thread(target=run_reference)
+        thread.start()
+        error, result, crashed, _ = sqlreduce.transaction_outcome(state, 'conn', state.database, func)
+        thread.join()
+        reference_error, reference, reference_crashed, _ = reference_result[0]
+        state.crashed = crashed or reference_crashed
+        state.hangs += (error == 'hang') + (reference_error == 'hang')
+
+        if error != 'no error' or reference_error != 'no error':
+            return f"{error} | {reference_error}"
+        if result != reference:
+            return "results differ"
+        return "same results"
@@ -0,0 +1,120 @@
+"""
+Resource guard for runaway candidates
+
+Removing WHERE or JOIN quals turns selective queries into cartesian products,
+and replacing constants can produce generate_series() bombs. Such candidates
+run into the statement timeout, fill temp files, or make the server run out of
+memory, which can crash it and needs an extra restart.
+
+A guard profile limits what candidates can do:
+    * temp_file_limit, work_mem: set as session defaults on every connection
+      (temp_file_limit can only be set by superusers, or roles granted SET on
+      it, check() leaves it out otherwise)
+    * max_rows, max_cost: before running a query, its plan is checked with
+      EXPLAIN; queries where any plan node is estimated to return more than
+      max_rows rows, or whose total cost exceeds max_cost, are not run
+
+Guard trips (including running out of temp file space or memory) yield an
+outcome starting with "resource guard:" instead of an error, so they are never
+mistaken for the expected error and are counted separately.
+"""
+
+import psycopg2
+import pglast
+from pglast.parser import ParseError
+
+import sqlreduce
+
+guard_prefix = "resource guard:"
+
+# SQL states of errors caused by the limits: configuration_limit_exceeded
+# (temp_file_limit), out_of_memory, disk_full
+guard_sqlstates = {'53400': 'temp_file_limit exceeded', '53200': 'out of memory', '53100': 'disk full'}
+
+default_profile = 'temp_file_limit=1GB,work_mem=4MB,max_rows=1e8,max_cost=1e9'
+
+# settings passed in the connection options
+session_settings = ('temp_file_limit', 'work_mem')
+
+explainable = (pglast.ast.SelectStmt, pglast.ast.InsertStmt, pglast.ast.UpdateStmt, pglast.ast.DeleteStmt)
+
+class GuardTripped(Exception):
+    def __str__(self):
+        return f"{guard_prefix} {self.args[0]}"
+
+def is_explainable(query):
+    try:
+        parsetree = pglast.parse_sql(query)
+    except ParseError:
+        return False
+    return len(parsetree) == 1 and isinstance(parsetree[0].stmt, explainable)
+
+def max_plan_rows(plan):
+    return max([plan.get('Plan Rows', 0)] + [max_plan_rows(subplan) for subplan in plan.get('Plans', [])])
+
+class Guard:
+    """Resource guard profile"""
+
+    def __init__(self, temp_file_limit=None, work_mem=None, max_rows=None, max_cost=None):
+        self.temp_file_limit = temp_file_limit
+        self.work_mem = work_mem
+        self.max_rows = max_rows
+        self.max_cost = max_cost
+        self.checked = False
+
+    @classmethod
+    def parse(cls, profile):
+        """Create guard from a "key=value,..." string"""
+
+        settings = {}
+        for item in profile.split(','):
+            key, _, value = item.strip().partition('=')
+            if key not in ('temp_file_limit', 'work_mem', 'max_rows', 'max_cost'):
+                raise ValueError(f"unknown guard setting {key}")
+            settings[key] = float(value) if key in ('max_rows', 'max_cost') else value
+        return cls(**settings)
+
+    def options(self):
+        """Session settings for the connection options"""
+
+        settings = []
+        for key in session_settings:
+            if getattr(self, key) is not None:
+                settings.append(f"-c {key}={getattr(self, key)}")
+        return ' '.join(settings)
+
+    def check(self, database):
+        """Drop the session settings the user can't set on database, returns
+        their names"""
+
+        if self.checked:
+            return []
+        keys = [key for key in session_settings if getattr(self, key) is not None]
+        if keys:
+            conn = psycopg2.connect(database, fallback_application_name='sqlreduce')
+            try:
+                names = sqlreduce.settable_settings(conn.cursor(), keys)
+            finally:
+                conn.close()
+            keys = [key for key in keys if key not in names]
+            for key in keys:
+                setattr(self, key, None)
+        self.checked = True
+        return keys
+
+    def execute(self, cur, query):
+        """Check plan of query, then run it"""
+
+        if (self.max_rows is not None or self.max_cost is not None) and is_explainable(query):
+            cur.execute(f"explain (format json) {query}")
+            plan = cur.fetchone()[0][0]['Plan']
+            if self.max_cost is not None and plan['Total Cost'] > self.max_cost:
+                raise GuardTripped(f"plan cost {plan['Total Cost']:.0f} exceeds {self.max_cost:.0f}")
+            if self.max_rows is not None and (rows := max_plan_rows(plan)) > self.max_rows:
+                raise GuardTripped(f"plan rows {rows:.0f} exceed {self.max_rows:.0f}")
+        try:
+            cur.execute(query)
+        except psycopg2.Error as e:
+            if e.pgcode in guard_sqlstates:
+                raise GuardTripped(guard_sqlstates[e.pgcode])
+            raise
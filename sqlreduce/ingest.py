@@ -0,0 +1,204 @@
+"""
+Ingest logs of failing queries and pick representatives for reduction
+
+SQLsmith runs produce large numbers of failing queries, many of which hit the
+same bug. Instead of reducing every one of them, the logs are streamed (never
+loaded into memory as a whole), queries are grouped by their error, and only
+the shortest few queries with distinct pglast fingerprints are kept per group.
+
+Supported log formats:
+    * csv: export of SQLsmith's error table (or any CSV file with a header
+      containing "query" and "msg" or "error" columns, and optionally "sqlstate")
+    * pglog: PostgreSQL server log in stderr format, ERROR/FATAL/PANIC messages
+      followed by STATEMENT lines, and crashes ("server process ... was
+      terminated by signal") followed by "Failed process was running:"
+    * sql: plain queries terminated by ";" at the end of a line; the error is
+      determined by running each query against the database
+
+Files ending in .gz are decompressed on the fly.
+"""
+
+import argparse
+import csv
+import gzip
+import re
+import sys
+
+from pglast.parser import fingerprint, ParseError
+
+def open_log(filename):
+    if filename == '-':
+        return sys.stdin
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', errors='replace')
+    return open(filename, errors='replace')
+
+def read_csv_log(f):
+    """Yield (error, sqlstate, query) from a CSV file"""
+
+    csv.field_size_limit(sys.maxsize)
+    for row in csv.DictReader(f):
+        error = row.get('msg') or row.get('error')
+        query = row.get('query')
+        if error and query:
+            yield error, row.get('sqlstate') or None, query
+
+log_message = re.compile(r'\b(ERROR|FATAL|PANIC|LOG|DETAIL|HINT|CONTEXT|STATEMENT|WARNING|NOTICE):  (.*)', re.DOTALL)
+crash_message = re.compile(r'server process \(PID \d+\) was terminated by (.*)')
+
+def log_records(f):
+    """Join continuation lines (starting with a tab) of a server log"""
+
+    record = None
+    for line in f:
+        line = line.rstrip('\n')
+        if line.startswith('\t') and record is not None:
+            record.append(line[1:])
+            continue
+        if record is not None:
+            yield '\n'.join(record)
+        record = [line]
+    if record is not None:
+        yield '\n'.join(record)
+
+def read_pg_log(f):
+    """Yield (error, sqlstate, query) from a PostgreSQL server log"""
+
+    error = None
+    for record in log_records(f):
+        match = log_message.search(record)
+        if not match:
+            continue
+        level, message = match.groups()
+
+        if level in ('ERROR', 'FATAL', 'PANIC'):
+            error = level + ':  ' + message.partition('\n')[0]
+        elif level == 'LOG' and (crash := crash_message.search(message)):
+            error = f"CRASH: {crash.group(1)}"
+        elif level == 'STATEMENT' and error and not error.startswith('CRASH'):
+            yield error, None, message
+            error = None
+        elif level == 'DETAIL' and error and error.startswith('CRASH') and \
+                message.startswith('Failed process was running: '):
+            yield error, None, message[len('Failed process was running: '):]
+            error = None
+
+def sql_statements(f):
+    """Yield the statements of a file of queries terminated by ';' at the end
+    of a line, the last one may lack the ';'"""
+
+    query = []
+    for line in f:
+        query.append(line)
+        if line.rstrip().endswith(';'):
+            yield ''.join(query).strip()
+            query = []
+    if text := ''.join(query).strip():
+        yield text
+
+def read_sql_log(f, state):
+    """Yield (error, sqlstate, query) from a file of queries by running them"""
+
+    from sqlreduce import run_query
+
+    for text in sql_statements(f):
+        error = run_query(state, text)
+        if error != 'no error':
+            yield error, None, text
+
+def error_class(error, sqlstate):
+    """Normalize an error message for grouping: drop the position and replace
+    numbers (OIDs, pointers, sizes) that vary between otherwise identical errors"""
+
+    error = re.sub(r' at character \d+$', '', error.partition('\n')[0])
+    error = re.sub(r'\b0x[0-9a-fA-F]+\b', '0x?', error)
+    error = re.sub(r'\b\d+\b', '?', error)
+    if sqlstate:
+        return f"{sqlstate} {error}"
+    return error
+
+def ingest(records, representatives=1):
+    """Group (error, sqlstate, query) records by error class. Per group, keep the
+    shortest queries with distinct fingerprints, at most representatives many.
+    Returns the groups and statistics."""
+
+    groups = {}
+    stats = {'queries': 0, 'unparsable': 0}
+
+    for error, sqlstate, query in records:
+        stats['queries'] += 1
+        try:
+            fp = fingerprint(query)
+        except ParseError:
+            stats['unparsable'] += 1
+            continue
+
+        group = groups.setdefault(error_class(error, sqlstate), {'error': error, 'count': 0, 'fingerprints': set(), 'queries': []})
+        group['count'] += 1
+        group['fingerprints'].add(fp)
+
+        queries = group['queries']
+        for i, (fp2, query2) in enumerate(queries):
+            if fp2 == fp:
+                if len(query) < len(query2):
+                    queries[i] = (fp, query)
+                break
+        else:
+            if len(queries) < representatives:
+                queries.append((fp, query))
+            else:
+                longest = max(range(len(queries)), key=lambda i: len(queries[i][1]))
+                if len(query) < len(queries[longest][1]):
+                    queries[longest] = (fp, query)
+
+    for group in groups.values():
+        group['queries'].sort(key=lambda q: len(q[1]))
+        group['fingerprints'] = len(group['fingerprints'])
+    stats['groups'] = len(groups)
+
+    return groups, stats
+
+def read_logs(filenames, log_format, state):
+    for filename in filenames:
+        with open_log(filename) as f:
+            if log_format == 'csv':
+                for record in read_csv_log(f): yield record
+            elif log_format == 'pglog':
+                for record in read_pg_log(f): yield record
+            else:
+                for record in read_sql_log(f, state): yield record
+
+def ingest_main(argv):
+    argparser = argparse.ArgumentParser(prog="sqlreduce ingest",
+            description="Group failing queries from logs by error and reduce one representative per group")
+    argparser.add_argument("-d", "--database", type=str, default="", help="Database or connection string to use")
+    argparser.add_argument("--format", choices=('csv', 'pglog', 'sql'), default='pglog', help="Log format [Default: pglog]")
+    argparser.add_argument("-n", "--representatives", type=int, default=1, help="Number of queries to keep per group [Default: 1]")
+    argparser.add_argument("--reduce", action='store_true', help="Reduce the representatives")
+    argparser.add_argument("--sqlstate", action='store_true', help="Reduce query to same SQL state instead of error message")
+    argparser.add_argument("-t", "--timeout", default='500ms', help="Statement timeout [Default: 500ms]")
+    argparser.add_argument("logs", nargs='+', help="Log files to read, - for stdin")
+    args = argparser.parse_args(argv)
+
+    import sqlreduce
+
+    if not '=' in args.database:
+        args.database = f"dbname={args.database}"
+    if args.format == 'sql' or args.reduce:
+        sqlreduce.check_connection(args.database)
+    reducer = sqlreduce.Reducer(database=args.database, timeout=args.timeout, use_sqlstate=args.sqlstate)
+
+    groups, stats = ingest(read_logs(args.logs, args.format, reducer), args.representatives)
+    print(f"Read {stats['queries']} queries, {stats['unparsable']} unparsable, {stats['groups']} groups")
+    print()
+
+    for group in sorted(groups.values(), key=lambda g: g['count'], reverse=True):
+        print(f"{group['error']} ({group['count']} queries, {group['fingerprints']} fingerprints)")
+        for fp, query in group['queries']:
+            if args.reduce:
+                print("   ", reducer.reduce(query))
+            else:
+                print("   ", ' '.join(query.split()))
+        print()
+
+    reducer.close()
@@ -0,0 +1,138 @@
+"""
+Knowledge base of reduction outcomes shared across runs
+
+Queries generated by SQLsmith are built from the same library of building
+blocks, so reducing many queries for the same bug means learning over and over
+that e.g. CAST(NULL AS circle) cannot be removed. The knowledge base records,
+per error class, subtree, and action (the replacement tried for the subtree),
+how often the action succeeded and failed. It is stored in an SQLite file.
+
+reduce_step() consults it to order the candidates for a node: actions that
+succeeded before are tried first, unknown actions next, and actions that only
+ever failed (at least min_failures times) are skipped. Skipping is only a
+heuristic, so once the reduction reaches a fixpoint, a verification pass runs
+reduce_loop() again without skipping; the result is still a fixpoint of all
+reduction rules.
+"""
+
+import sqlite3
+
+from pglast import ast
+from pglast.stream import RawStream
+
+import sqlreduce
+from sqlreduce.ingest import error_class
+
+# skip actions that failed at least this often and never succeeded
+min_failures = 2
+
+def node_text(node):
+    """SQL text of a subtree, or None if it cannot be printed on its own"""
+
+    try:
+        if isinstance(node, tuple):
+            return '(' + ', '.join(node_text(item) or repr(item) for item in node) + ')'
+        if isinstance(node, ast.Node):
+            return RawStream()(node)
+        return repr(node)
+    except Exception:
+        return None
+
+def candidate_key(tree, path, path2, node):
+    """Return the (subtree, action) key of a candidate, or None. Removing an
+    element from a list is keyed by the element removed, so the outcome carries
+    over to lists with different other elements."""
+
+    subtree = sqlreduce.getattr_path(tree, path)
+    if path2 == path and isinstance(subtree, tuple) and isinstance(node, tuple) and len(node) == len(subtree) - 1:
+        i = next((i for i in range(len(node)) if node[i] is not subtree[i]), len(node))
+        text = node_text(subtree[i])
+        return (text, f"remove from {path[-1]}") if text is not None else None
+
+    text = node_text(subtree)
+    action = node_text(node)
+    if text is None or action is None:
+        return None
+    return text, '.'.join(str(p) for p in path2[len(path):]) + ':' + action
+
+class KnowledgeBase:
+    """Persistent (error class, subtree, action) -> outcome counters"""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute("""create table if not exists outcomes (
+                error_class text, subtree text, action text,
+                successes integer not null default 0, failures integer not null default 0,
+                primary key (error_class, subtree, action))""")
+        self.error_class = None
+        self.outcomes = {}
+        self.changed = set()
+        self.skipping = True
+        self.stats = {'skipped': 0, 'preferred': 0, 'recorded': 0}
+
+    def start(self, error):
+        """Load the outcomes recorded for error"""
+
+        self.error_class = error_class(error, None)
+        self.outcomes = {(subtree, action): [successes, failures] for subtree, action, successes, failures in
+                self.db.execute("select subtree, action, successes, failures from outcomes where error_class = ?", (self.error_class,))}
+        self.changed = set()
+        self.skipping = True
+        self.stats = {'skipped': 0, 'preferred': 0, 'recorded': 0}
+
+    def save(self):
+        self.db.executemany("""insert into outcomes values (?, ?, ?, ?, ?)
+                on conflict (error_class, subtree, action) do update set successes = excluded.successes, failures = excluded.failures""",
+                [(self.error_class, subtree, action, *self.outcomes[(subtree, action)]) for subtree, action in self.changed])
+        self.db.commit()
+        self.changed = set()
+
+    def close(self):
+        self.db.close()
+
+    def rank(self, key):
+        """0 for known successes, 1 for unknown, 2 for refuted actions"""
+
+        successes, failures = self.outcomes.get(key, (0, 0))
+        if successes > 0:
+            return 0
+        if failures >= min_failures:
+            return 2
+        return 1
+
+    def record(self, key, success):
+        outcome = self.outcomes.setdefault(key, [0, 0])
+        outcome[0 if success else 1] += 1
+        self.changed.add(key)
+        self.stats['recorded'] += 1
+
+    def reduce_step(self, state, path, candidates):
+        """reduce_step() with candidates ordered by past outcomes"""
+
+        ranked = []
+        for path2, node in candidates:
+            key = candidate_key(state.parsetree, path, path2, node)
+            rank = self.rank(key) if key else 1
+            ranked.append((rank, len(ranked), path2, node, key))
+        ranked.sort(key=lambda item: item[:2])
+
+        for rank, _, path2, node, key in ranked:
+            if rank == 2 and self.skipping:
+                self.stats['skipped'] += 1
+                continue
+            if rank == 0:
+                self.stats['preferred'] += 1
+
+            candidate = sqlreduce.prepare_candidate(state, path2, node)
+            if candidate is None:
+                continue
+            parsetree2, query = candidate
+            if state.verbose:
+                print(query, end='')
+            error = sqlreduce.run_query(state, query)
+            success = sqlreduce.check_candidate(state, parsetree2, query, error)
+            if key:
+                self.record(key, success)
+            if success:
+                return True
+        return False
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 import argparse
+import atexit
 import sys
 import time
 
@@ -10,11 +11,47 @@ import sqlreduce
 #from loguru import logger
 #@logger.catch
 def sqlreduce_main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'ingest':
+        from sqlreduce.ingest import ingest_main
+        return ingest_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from sqlreduce.serve import serve_main
+        return serve_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        from sqlreduce.bench import bench_main
+        return bench_main(sys.argv[2:])
+
     argparser = argparse.ArgumentParser(description="Reduce a SQL query to the minimal query throwing the same error")
     argparser.add_argument("-d", "--database", type=str, default="", help="Database or connection string to use")
+    argparser.add_argument("--cluster", nargs='?', const='', metavar='SCHEMA', help="Run on a throwaway local cluster tuned for fast crash recovery, optionally loading SCHEMA (an SQL file) into it")
+    argparser.add_argument("--pg-bindir", metavar='DIR', help="PostgreSQL programs for --cluster [Default: from pg_config]")
     argparser.add_argument("-f", "--file", type=argparse.FileType('r'), default=sys.stdin, help="Read query from file [Default: stdin]")
     argparser.add_argument("--sqlstate", action='store_true', help="Reduce query to same SQL state instead of error message")
     argparser.add_argument("-t", "--timeout", default='500ms', help="Statement timeout [Default: 500ms]")
+    argparser.add_argument("--bulk", action='store_true', help="Try reducing all nodes of a kind at once before the main loop")
+    argparser.add_argument("--pipeline", type=int, default=0, metavar='N', help="Run N queries per round trip using libpq pipeline mode (requires psycopg 3) [Default: off]")
+    argparser.add_argument("-j", "--jobs", type=int, default=1, metavar='N', help="Reduce independent parts of the query on N connections in parallel [Default: 1]")
+    argparser.add_argument("--tune", action='store_true', help="Run candidates with cost-reducing session settings (jit=off etc.) that keep the error")
+    argparser.add_argument("--prefetch", type=int, default=0, metavar='N', help="Prepare up to N candidates in a separate thread while a query runs [Default: off]")
+    argparser.add_argument("--guided", action='store_true', help="Try reducing parts of the query far from the reported error position first")
+    argparser.add_argument("--no-prune", action='store_true', help="Run candidates even if they remove tables or CTEs the query still refers to")
+    argparser.add_argument("--reconnect", action='store_true', help="Use a new database connection for each query")
+    argparser.add_argument("--max-time", type=float, metavar='SECONDS', help="Stop after this many seconds and return the best query found so far")
+    argparser.add_argument("--max-queries", type=int, metavar='N', help="Stop after running this many queries and return the best query found so far")
+    argparser.add_argument("--compare", metavar='DATABASE', help="Reduce query to one returning different results on DATABASE instead of an error")
+    argparser.add_argument("--slow", type=float, metavar='THRESHOLD', help="Reduce query to one taking longer than THRESHOLD seconds (or cost units with --metric cost)")
+    argparser.add_argument("--slow-ratio", type=float, metavar='RATIO', help="Reduce query to one taking RATIO times longer than on the --compare database")
+    argparser.add_argument("--metric", choices=('time', 'analyze', 'cost'), default='time', help="Measurement for --slow: wall-clock time, EXPLAIN ANALYZE execution time, or plan cost [Default: time]")
+    argparser.add_argument("--runs", type=int, default=10, help="Maximum number of measurements per query for --slow [Default: 10]")
+    argparser.add_argument("--plan", action='append', metavar='PREDICATE', help="Reduce query to one whose EXPLAIN output satisfies PREDICATE, e.g. '..Node Type == \"Gather\"' (can be repeated)")
+    argparser.add_argument("--server-stats", action='store_true', help="Report server time per candidate class from pg_stat_statements")
+    argparser.add_argument("--knowledge", metavar='FILE', help="Order reduction steps by outcomes recorded in FILE from earlier runs, and record new outcomes")
+    argparser.add_argument("--confirm", type=int, default=0, metavar='N', help="Run matching queries N more times before accepting them, for flaky queries [Default: 0]")
+    argparser.add_argument("--verify", action='append', metavar='DATABASE', help="After reducing, run the minimal query on DATABASE and report if it is affected (can be repeated, run in parallel)")
+    argparser.add_argument("--bisect", action='store_true', help="Treat the --verify databases as ordered list of builds and bisect for the first affected one")
+    argparser.add_argument("--guard", nargs='?', const='default', metavar='PROFILE', help="Limit resources used by candidates, PROFILE is a list of temp_file_limit, work_mem, max_rows, max_cost settings [Default profile: temp_file_limit=1GB,work_mem=4MB,max_rows=1e8,max_cost=1e9]")
+    argparser.add_argument("--hang-timeout", type=float, metavar='SECONDS', help="Interrupt queries still running after SECONDS despite the statement timeout, 0 to disable [Default: statement timeout + 60]")
+    argparser.add_argument("-o", "--output", metavar='FILE', help="Write the best query found so far to FILE whenever it improves")
     argparser.add_argument("--debug", action='store_true')
     argparser.add_argument("query", nargs='*', help="Query to reduce to minimum")
     args = argparser.parse_args()
@@ -27,11 +64,52 @@ def sqlreduce_main():
     else:
         query = args.file.read().rstrip()
 
+    if args.cluster is not None:
+        if args.database:
+            raise Exception("Cannot use both -d and --cluster")
+        from sqlreduce.cluster import Cluster
+        cluster = Cluster(bindir=args.pg_bindir, schema=args.cluster or None)
+        atexit.register(cluster.stop)
+        args.database = cluster.start()
+
     # check database connection
     if not '=' in args.database:
         args.database = f"dbname={args.database}"
     sqlreduce.check_connection(args.database)
 
+    oracle = None
+    if args.compare:
+        if not '=' in args.compare:
+            args.compare = f"dbname={args.compare}"
+        sqlreduce.check_connection(args.compare)
+    if args.plan:
+        from sqlreduce.plan import PlanOracle
+        oracle = PlanOracle(args.plan)
+    elif args.slow is not None or args.slow_ratio is not None:
+        from sqlreduce.perf import PerfOracle
+        if args.slow_ratio is not None and not args.compare:
+            raise Exception("--slow-ratio needs a reference database given with --compare")
+        oracle = PerfOracle(threshold=args.slow, ratio=args.slow_ratio,
+                reference=args.compare if args.slow_ratio is not None else None,
+                metric=args.metric, runs=args.runs)
+    elif args.compare:
+        from sqlreduce.compare import CompareOracle
+        oracle = CompareOracle(args.compare)
+
+    guard = None
+    if args.guard:
+        from sqlreduce.guard import default_profile, Guard
+        guard = Guard.parse(default_profile if args.guard == 'default' else args.guard)
+
+    knowledge = None
+    if args.knowledge:
+        from sqlreduce.knowledge import KnowledgeBase
+        knowledge = KnowledgeBase(args.knowledge)
+
+    progress = None
+    if args.output:
+        progress = lambda best_query: sqlreduce.write_file_atomic(args.output, best_query)
+
     # reduce query
     start = time.time()
     min_query, state = sqlreduce.run_reduce(query,
@@ -40,24 +118,80 @@ def sqlreduce_main():
             use_sqlstate=args.sqlstate,
             timeout=args.timeout,
             debug=args.debug,
+            bulk=args.bulk,
+            pipeline=args.pipeline,
+            reconnect=args.reconnect,
+            max_time=args.max_time,
+            max_queries=args.max_queries,
+            progress=progress,
+            oracle=oracle,
+            server_stats=args.server_stats,
+            knowledge=knowledge,
+            confirm=args.confirm,
+            guard=guard,
+            hang_timeout='auto' if args.hang_timeout is None else args.hang_timeout or None,
+            jobs=args.jobs,
+            tune=args.tune,
+            prefetch=args.prefetch,
+            prune=not args.no_prune,
+            guided=args.guided,
             )
     duration = time.time() - start
-    qps = len(state['seen']) / duration
+    qps = len(state.seen) / duration
+
+    if args.output:
+        sqlreduce.write_file_atomic(args.output, min_query)
 
     print()
-    print("Minimal query yielding the same error:")
-    if state['terminal']:
+    if state.budget_exhausted:
+        print("Smallest query found before the budget ran out:")
+    else:
+        print("Minimal query yielding the same error:")
+    if state.terminal:
         print("\033[1m", end="")
     print(min_query)
-    if state['terminal']:
+    if state.terminal:
         print("\033[0m", end="")
     print()
     print("Pretty-printed minimal query:")
-    print(IndentedStream(comma_at_eoln=True)(state['parsetree']))
+    print(IndentedStream(comma_at_eoln=True)(state.parsetree))
     print()
-    print("Seen:", len(state['seen']), "items,", sum([len(v) for v in state['seen']]), "Bytes")
-    print("Iterations:", state['called'])
+    print("Seen:", len(state.seen), "items,", sum([len(v) for v in state.seen]), "Bytes")
+    print("Iterations:", state.called, f"({state.duplicates} duplicates skipped before rendering)")
     print(f"Runtime: {duration:.3f} s, {qps:.1f} q/s")
+    if state.pruned:
+        print("Pruned candidates:", state.pruned, "(not run because they break name references)")
+    if args.tune:
+        from sqlreduce.tuning import options
+        print("Session settings:", options(state.session_settings) or "(defaults)")
+    if guard:
+        print("Resource guard trips:", state.guard_trips)
+    if state.hangs:
+        print("Hanging queries interrupted:", state.hangs)
+    if args.confirm:
+        print(f"Confirmations: {state.confirmations} queries, {state.confirm_failures} flaky candidates rejected")
+    if knowledge:
+        print(f"Knowledge base: {knowledge.stats['preferred']} preferred, {knowledge.stats['skipped']} skipped, {knowledge.stats['recorded']} outcomes recorded")
+        knowledge.close()
+    if args.verify:
+        from sqlreduce import matrix
+        databases = [database if '=' in database else f"dbname={database}" for database in args.verify]
+        print()
+        if args.bisect:
+            first, tried = matrix.bisect_builds(min_query, databases, state.expected_error, args.timeout, args.sqlstate)
+            print("Bisecting builds:")
+            matrix.print_matrix(tried)
+            if first < len(databases):
+                print("First affected build:", databases[first])
+            else:
+                print("No build is affected")
+        else:
+            print("Verification matrix:")
+            matrix.print_matrix(matrix.verify_matrix(min_query, databases, state.expected_error, args.timeout, args.sqlstate))
+    if state.stats_report:
+        print()
+        from sqlreduce.stats import print_report
+        print_report(state.stats_report)
     #print(state)
 
 if __name__ == "__main__":
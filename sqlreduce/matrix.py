@@ -0,0 +1,61 @@
+"""
+Verification matrix: run a reduced query against several PostgreSQL builds
+
+To find out which versions are affected by a bug, the minimal query is run
+against a list of databases, e.g. one per build made with examples/pg-build.sh
+on different ports. All builds are queried in parallel. A build is affected
+when the query yields the same error (or SQL state) as during the reduction.
+
+With an ordered list of builds (e.g. by version or commit), bisect_builds()
+finds the first affected build, assuming all builds after it are affected as
+well, by running the query on O(log n) builds only.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlreduce
+
+def run_on(database, query, timeout='500ms', use_sqlstate=False):
+    """Run query on database, returns the error"""
+
+    # run_query() waits for the server to come back indefinitely, don't hang on builds that are down
+    try:
+        sqlreduce.check_connection(database)
+    except Exception as e:
+        return "connection failed: " + str(e).strip().partition('\n')[0]
+
+    reducer = sqlreduce.Reducer(database=database, timeout=timeout, use_sqlstate=use_sqlstate)
+    try:
+        return sqlreduce.run_query(reducer, query)
+    finally:
+        reducer.close()
+
+def verify_matrix(query, databases, expected, timeout='500ms', use_sqlstate=False):
+    """Run query on all databases in parallel. Returns a list of (database,
+    affected, error) tuples in the order of databases."""
+
+    with ThreadPoolExecutor(max_workers=max(len(databases), 1)) as executor:
+        errors = list(executor.map(lambda database: run_on(database, query, timeout, use_sqlstate), databases))
+    return [(database, error == expected, error) for database, error in zip(databases, errors)]
+
+def bisect_builds(query, databases, expected, timeout='500ms', use_sqlstate=False):
+    """Find the first affected database in an ordered list where all databases
+    from some point on are affected. Returns its index (len(databases) if none
+    is affected) and the (database, affected, error) tuples of builds tried."""
+
+    tried = []
+    low, high = 0, len(databases)
+    while low < high:
+        middle = (low + high) // 2
+        error = run_on(databases[middle], query, timeout, use_sqlstate)
+        tried.append((databases[middle], error == expected, error))
+        if error == expected:
+            high = middle
+        else:
+            low = middle + 1
+    return low, tried
+
+def print_matrix(results):
+    width = max(len(database) for database, affected, error in results)
+    for database, affected, error in results:
+        print(f"    {database:<{width}}  {'affected  ' if affected else 'unaffected'}  {error}")
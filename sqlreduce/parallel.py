@@ -0,0 +1,270 @@
+"""
+Reducing independent parts of a query in parallel
+
+reduce_loop() works on one tree and runs one candidate at a time. On wide
+queries (many CTEs, FROM items, target list entries, UNION arms), most
+reduction steps touch parts of the tree that don't depend on each other, so
+they can be tried at the same time on separate connections.
+
+partition() splits the parse tree into disjoint regions by repeatedly
+replacing the largest region by its children until there are a few regions per
+worker. Each worker takes the next region from a shared queue (largest first,
+so idle workers pick up the remaining small regions while others are still
+busy) and reduces it on its own copy of the tree, holding all other regions
+fixed. A region that is a list element first tries removing itself from the
+list. The remaining reductions (nodes above the regions, pulling up subqueries
+to the top level, which often removes most of the query at once) are tried
+serially before each round.
+
+The reduced regions are then put together in one tree. Regions can interact,
+so the combined tree is verified; if it does not yield the expected error, the
+region results are applied one at a time instead, keeping those that still
+work. This is repeated while several regions make progress. Afterwards the normal serial
+reduce_loop() runs on the result, so the final query is a fixpoint of all
+reduction rules just as without parallelism.
+"""
+
+import queue
+import threading
+
+import sqlreduce
+
+# aim for this many regions per worker so the queue balances uneven regions
+regions_per_job = 4
+
+# don't split regions with fewer reduction targets than this
+min_region_size = 8
+
+# marker for regions that removed themselves from their list
+removed = object()
+
+def tree_size(node, path):
+    return sum(1 for p in sqlreduce.enumerate_paths(node, path))
+
+def children(tree, region):
+    """Reduction targets directly below region"""
+
+    paths = [p for p in sqlreduce.enumerate_paths(sqlreduce.getattr_path(tree, region), region) if p != region]
+    return [p for p in paths if not any(q != p and q == p[:len(q)] for q in paths)]
+
+def partition(tree, jobs):
+    """Split tree into disjoint regions, returns a list of paths, largest region first"""
+
+    regions = [(tree_size(tree, []), [])]
+    unsplittable = []
+    while regions and len(regions) + len(unsplittable) < jobs * regions_per_job:
+        regions.sort(key=lambda region: region[0])
+        size, region = regions.pop()
+        if size < min_region_size:
+            unsplittable.append((size, region))
+            break
+        subregions = children(tree, region)
+        if not subregions:
+            unsplittable.append((size, region))
+            continue
+        regions += [(tree_size(sqlreduce.getattr_path(tree, p), p), p) for p in subregions]
+    regions = sorted(regions + unsplittable, key=lambda region: -region[0])
+    return [region for size, region in regions]
+
+def worker_reducer(state):
+    """Reducer for a worker thread, sharing the seen sets with state"""
+
+    worker = sqlreduce.Reducer(database=state.database, use_sqlstate=state.use_sqlstate, timeout=state.timeout,
+            reconnect=state.reconnect, max_queries=state.max_queries, confirm=state.confirm, guard=state.guard,
+            hang_timeout=state.hang_timeout)
+    for counter in ('called', 'confirm_failures', 'confirmations', 'duplicates', 'guard_trips', 'hangs', 'pruned'):
+        setattr(worker, counter, 0)
+    worker.budget_exhausted = False
+    worker.crashed = False
+    worker.deadline = state.deadline
+    worker.expected_crash = state.expected_crash
+    worker.expected_error = state.expected_error
+    worker.flaky_input = None
+    worker.hash_cache = {}
+    worker.pruning = state.pruning
+    worker.regenerated_query = state.regenerated_query
+    worker.session_settings = state.session_settings
+    worker.text_cache = {}
+    # the same query text yields the same result in all workers
+    worker.seen = state.seen
+    worker.seen_hashes = state.seen_hashes
+    return worker
+
+def reduce_region(state, region, removable):
+    """Reduce the nodes below region in state.parsetree. Returns the reduced
+    region, or removed if the region could be removed from its list."""
+
+    if removable:
+        parent = sqlreduce.getattr_path(state.parsetree, region[:-1])
+        i = region[-1]
+        if len(parent) > 1 and sqlreduce.try_reduce(state, region[:-1], parent[:i] + parent[i+1:]):
+            return removed
+
+    found = True
+    while found:
+        found = False
+        for path in sqlreduce.enumerate_paths(sqlreduce.getattr_path(state.parsetree, region), region):
+            for path2, node in sqlreduce.reduce_candidates(state, path):
+                # pulling up subqueries to the top level touches other regions
+                if path2[:len(region)] != region:
+                    continue
+                if sqlreduce.try_reduce(state, path2, node):
+                    found = True
+                    break
+            if found:
+                break
+    return sqlreduce.getattr_path(state.parsetree, region)
+
+def inside(path, regions):
+    return any(path[:len(region)] == region for region in regions)
+
+def reduce_spine(state, regions, removable):
+    """Try the reductions the workers don't try: those of nodes outside all
+    regions, and pulling up subqueries to the top level. Returns True on the
+    first successful one, the regions need to be recomputed then."""
+
+    worker_removals = {(tuple(region[:-1]), region[-1]) for region, flag in zip(regions, removable) if flag}
+    for path in sqlreduce.enumerate_paths(state.parsetree):
+        path_inside = inside(path, regions)
+        for path2, node in sqlreduce.reduce_candidates(state, path):
+            if inside(path2, regions):
+                continue
+            # removing a list element that is a region is done by the worker
+            if not path_inside and path2 == path and isinstance(node, tuple):
+                parent = sqlreduce.getattr_path(state.parsetree, path)
+                i = next((i for i in range(len(node)) if node[i] is not parent[i]), len(node))
+                if (tuple(path), i) in worker_removals:
+                    continue
+            if sqlreduce.try_reduce(state, path2, node):
+                return True
+    return False
+
+def apply_results(tree, results):
+    """Put reduced regions into tree. Paths refer to tree, so replacements are
+    done first, and removals last, from nested lists outwards."""
+
+    removals = {}
+    for region, result in results:
+        if result is removed:
+            removals.setdefault(tuple(region[:-1]), []).append(region[-1])
+        else:
+            tree = sqlreduce.setattr_path(tree, region, result)
+    for parent, indexes in sorted(removals.items(), key=lambda removal: -len(removal[0])):
+        node = sqlreduce.getattr_path(tree, list(parent))
+        # keep one element if all of them were removed
+        if len(indexes) >= len(node):
+            indexes.remove(max(indexes))
+        node = tuple(item for i, item in enumerate(node) if i not in indexes)
+        tree = sqlreduce.setattr_path(tree, list(parent), node)
+    return tree
+
+def run_workers(state, tree, regions, removable):
+    """Reduce regions of tree in the state.workers threads. Returns (region, result,
+    tree) for the regions that changed, in the order of regions, where tree is
+    the worker's tree with only that region reduced."""
+
+    todo = queue.Queue()
+    for i, region in enumerate(regions):
+        todo.put((i, region))
+    results = [None] * len(regions)
+    finals = [None] * len(regions)
+    best = []
+    failures = []
+
+    def work(worker):
+        try:
+            while not state.cancelled:
+                try:
+                    i, region = todo.get_nowait()
+                except queue.Empty:
+                    return
+                worker.parsetree = tree
+                try:
+                    results[i] = reduce_region(worker, region, removable[i])
+                    finals[i] = worker.parsetree
+                except sqlreduce.Cancelled:
+                    # keep the best tree found before the budget ran out
+                    if worker.parsetree is not tree:
+                        best.append(worker.parsetree)
+                    raise
+        except Exception as e:
+            failures.append(e)
+
+    # candidates accepted by workers might not make it into the merged tree
+    accepted = []
+    for worker in state.workers:
+        worker.progress = lambda query, worker=worker: accepted.append((query, sqlreduce.node_hash(worker.parsetree, worker.hash_cache)))
+    threads = [threading.Thread(target=work, args=(worker,), name=f'sqlreduce-worker-{i}') for i, worker in enumerate(state.workers)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for query, tree_hash in accepted:
+            state.seen.discard(query)
+            state.seen_hashes.discard(tree_hash)
+
+    if failures:
+        if best:
+            state.parsetree = min(best, key=lambda tree: len(sqlreduce.RawStream()(tree)))
+        raise failures[0]
+
+    return [(region, result, final) for region, result, final in zip(regions, results, finals)
+            if final is not None and final is not tree]
+
+def merge_results(state, tree, results):
+    """Make the combination of all region results the new parse tree, or if it
+    does not yield the expected error, as many of them as possible"""
+
+    if len(results) > 1 and sqlreduce.try_reduce(state, [], apply_results(tree, [result[:2] for result in results])):
+        return
+
+    # the tree of the first region was verified by its worker
+    region, result, final = results[0]
+    state.parsetree = final
+    # it was dropped from the seen sets along with the other worker results
+    query = sqlreduce.RawStream()(final)
+    state.seen.add(query)
+    state.seen_hashes.add(sqlreduce.node_hash(final, state.hash_cache))
+    if state.progress:
+        state.progress(query)
+    applied = [(region, result)]
+    for region, result, final in results[1:]:
+        if sqlreduce.try_reduce(state, [], apply_results(tree, applied + [(region, result)])):
+            applied.append((region, result))
+
+def reduce_parallel(state):
+    """Reduce disjoint regions of the parse tree in parallel while several of
+    them make progress"""
+
+    state.workers = [worker_reducer(state) for i in range(state.jobs)]
+    try:
+        reduce_rounds(state)
+    finally:
+        for worker in state.workers:
+            for counter in ('called', 'confirm_failures', 'confirmations', 'duplicates', 'guard_trips', 'hangs', 'pruned'):
+                setattr(state, counter, getattr(state, counter) + getattr(worker, counter))
+            worker.close()
+        state.workers = []
+
+def reduce_rounds(state):
+    while True:
+        tree = state.parsetree
+        regions = partition(tree, state.jobs)
+        if len(regions) < 2:
+            return
+        targets = {tuple(path) for path in sqlreduce.enumerate_paths(tree)}
+        removable = [bool(region) and isinstance(region[-1], int) and tuple(region[:-1]) in targets for region in regions]
+        if reduce_spine(state, regions, removable):
+            continue
+
+        results = run_workers(state, tree, regions, removable)
+        if state.verbose:
+            print(f"Reduced {len(results)} of {len(regions)} regions in parallel")
+        if not results:
+            return
+        merge_results(state, tree, results)
+        # with only one region left changing, the serial loop is just as fast
+        if state.parsetree is tree or len(results) < 2:
+            return
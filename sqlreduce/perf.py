@@ -0,0 +1,111 @@
+"""
+Performance oracle: reduce queries to the minimal query that is still slow
+
+The outcome of a candidate is "slow" or "fast" (or the error it yields). A
+candidate is slow if its measurement exceeds a threshold, or, with a
+reference database, if it is slower on the database being reduced against than
+on the reference database by at least a given ratio.
+
+Metrics:
+    * time: wall-clock time of running the query, including fetching the result
+    * analyze: execution time reported by EXPLAIN (ANALYZE)
+    * cost: total cost of the plan estimated by EXPLAIN (nothing is executed)
+
+Timings are noisy, so the query is run repeatedly (up to runs times) and the
+95% confidence interval of the mean is compared with the threshold. The
+measurement stops early as soon as the interval lies completely above or below
+the threshold, and after a single run if that run took less than half the
+threshold, so clearly fast candidates cost only one execution. With a
+reference database, both databases are measured alternately and the interval is
+computed on the per-run ratios.
+
+The statement timeout (-t) should be set well above the threshold, candidates
+running into it yield an error and are not accepted.
+"""
+
+import math
+import time
+
+import sqlreduce
+
+# two-sided 95% quantiles of Student's t distribution by degrees of freedom
+t_quantiles = [None, 12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23]
+
+def confidence_interval(values):
+    """Return the 95% confidence interval of the mean of values"""
+
+    n = len(values)
+    mean = sum(values) / n
+    if n < 2:
+        return mean, mean
+    stddev = math.sqrt(sum((x - mean)**2 for x in values) / (n - 1))
+    t = t_quantiles[n - 1] if n - 1 < len(t_quantiles) else 1.96
+    half = t * stddev / math.sqrt(n)
+    return mean - half, mean + half
+
+def classify(values, threshold, runs):
+    """Decide if the measurements so far are above the threshold. Returns
+    'slow', 'fast', or None when more measurements are needed."""
+
+    if len(values) == 1 and values[0] < threshold / 2:
+        return 'fast'
+    low, high = confidence_interval(values)
+    if len(values) >= 2 and low > threshold:
+        return 'slow'
+    if len(values) >= 2 and high < threshold:
+        return 'fast'
+    if len(values) >= runs:
+        return 'slow' if sum(values) / len(values) > threshold else 'fast'
+    return None
+
+def measure(cur, query, metric):
+    """Run query once and return the measurement"""
+
+    if metric == 'time':
+        start = time.perf_counter()
+        cur.execute(query)
+        if cur.description is not None:
+            while cur.fetchmany(10000):
+                pass
+        return time.perf_counter() - start
+    if metric == 'analyze':
+        cur.execute(f"explain (analyze, timing off, format json) {query}")
+        return cur.fetchone()[0][0]['Execution Time'] / 1000
+    cur.execute(f"explain (format json) {query}")
+    return cur.fetchone()[0][0]['Plan']['Total Cost']
+
+class PerfOracle:
+    """Classify candidates as slow or fast"""
+
+    def __init__(self, threshold=None, ratio=None, reference=None, metric='time', runs=10):
+        assert metric in ('time', 'analyze', 'cost')
+        assert threshold is not None or (ratio is not None and reference is not None), "need either threshold, or ratio and reference"
+        self.threshold = threshold
+        self.ratio = ratio
+        self.reference = reference
+        self.metric = metric
+        # plan costs are deterministic
+        self.runs = 1 if metric == 'cost' else runs
+
+    def run_once(self, state, conn_attr, database, query):
+        return sqlreduce.run_in_transaction(state, conn_attr, database,
+                lambda cur: measure(cur, query, self.metric))
+
+    def run(self, state, query):
+        values = []
+        while True:
+            error, value = self.run_once(state, 'conn', state.database, query)
+            if error != 'no error':
+                return error
+            if self.reference:
+                reference_error, reference_value = self.run_once(state, 'reference_conn', self.reference, query)
+                if reference_error != 'no error':
+                    return f"{error} | {reference_error}"
+                value /= max(reference_value, 1e-6)
+            values.append(value)
+
+            outcome = classify(values, self.ratio if self.reference else self.threshold, self.runs)
+            if outcome:
+                if state.debug:
+                    print(f" [{outcome} after {len(values)} runs, mean {sum(values) / len(values):.6g}]", end='')
+                return outcome
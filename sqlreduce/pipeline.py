@@ -0,0 +1,121 @@
+"""
+Pipelined query execution using libpq pipeline mode via psycopg 3
+
+run_query() runs one candidate query at a time and waits for its result before
+the next candidate is generated. When the expected error does not crash the
+backend, several candidates can instead be sent in one batch on a persistent
+connection and all results read back in one network round trip.
+
+Each candidate runs in its own transaction which is always rolled back, like
+run_query() does with psycopg2. The pipeline is synchronized after each
+candidate so an error only aborts that candidate, and session state (lastval(),
+prepared statements, temp tables) is discarded before the next one, like
+run_query() does when it keeps its connection:
+
+    BEGIN; query 1; SYNC; ROLLBACK; SYNC; DISCARD ALL; SYNC; BEGIN; query 2; ...
+
+psycopg 3 is an optional dependency; pipelining is not available without it.
+"""
+
+import select
+
+import sqlreduce
+
+try:
+    import psycopg
+    from psycopg import pq
+except ImportError:
+    psycopg = None
+
+def pipeline_available():
+    return psycopg is not None and pq.version() >= 140000
+
+def pipeline_connect(state):
+    """Open a connection for pipelined queries"""
+
+    # settings are passed as session defaults so they survive DISCARD ALL
+    params = sqlreduce.connection_params(state)
+    return psycopg.connect(autocommit=True, fallback_application_name='sqlreduce', **params)
+
+def format_error(state, result):
+    """Format a query result the way run_query() does"""
+
+    if result.status != pq.ExecStatus.FATAL_ERROR:
+        return 'no error'
+    if state.use_sqlstate:
+        sqlstate = result.error_field(pq.DiagnosticField.SQLSTATE)
+        return sqlstate.decode() if sqlstate else "CRASH"
+    return result.error_message.decode(errors='replace').partition('\n')[0]
+
+def pipeline_commands(queries):
+    """Return the list of commands sent for a batch of queries"""
+
+    commands = []
+    for i, query in enumerate(queries):
+        commands.append(('begin', b"begin"))
+        commands.append((i, query.encode()))
+        commands.append(('sync', None))
+        commands.append(('rollback', b"rollback"))
+        commands.append(('sync', None))
+        # DISCARD ALL cannot run inside the implicit transaction block
+        commands.append(('discard', b"discard all"))
+        commands.append(('sync', None))
+    return commands
+
+def run_queries_pipelined(state, queries):
+    """Run a batch of queries in one round trip. Returns a list of errors in
+    the format of run_query(), with None for queries whose outcome is unknown
+    because the connection was lost."""
+
+    errors = [None] * len(queries)
+    try:
+        conn = state.pipeline_conn
+        if conn is None or conn.closed:
+            conn = state.pipeline_conn = pipeline_connect(state)
+        pgconn = conn.pgconn
+
+        commands = pipeline_commands(queries)
+        pgconn.nonblocking = 1
+        pgconn.enter_pipeline_mode()
+        for command, sql in commands:
+            if command == 'sync':
+                pgconn.pipeline_sync()
+            else:
+                pgconn.send_query_params(sql, None)
+
+        # results arrive in command order, each command's results are terminated
+        # by None, except for syncs which yield a single PIPELINE_SYNC result
+        current = 0
+        last_result = None
+        while current < len(commands):
+            flushed = pgconn.flush() == 0
+            select.select([pgconn.socket], [] if flushed else [pgconn.socket], [])
+            pgconn.consume_input()
+            while current < len(commands) and not pgconn.is_busy():
+                result = pgconn.get_result()
+                if pgconn.status == pq.ConnStatus.BAD:
+                    raise psycopg.OperationalError("connection lost")
+                command = commands[current][0]
+                if command == 'sync':
+                    assert result is not None and result.status == pq.ExecStatus.PIPELINE_SYNC
+                    current += 1
+                elif result is not None:
+                    last_result = result
+                else:
+                    if isinstance(command, int) and last_result.status != pq.ExecStatus.PIPELINE_ABORTED:
+                        errors[command] = format_error(state, last_result)
+                    last_result = None
+                    current += 1
+
+        pgconn.exit_pipeline_mode()
+        pgconn.nonblocking = 0
+
+    except (psycopg.Error, OSError):
+        # the server crashed or the connection was lost, give up on this batch
+        try:
+            state.pipeline_conn.close()
+        except Exception:
+            pass
+        state.pipeline_conn = None
+
+    return errors
@@ -0,0 +1,170 @@
+"""
+Plan-shape oracle: reduce queries to the minimal query whose plan has a feature
+
+Candidates are not executed; only EXPLAIN (FORMAT JSON) is run, so each
+candidate costs planning time only. The outcome is "plan matches" when all
+predicates hold for the plan, "plan does not match" otherwise (or the error
+EXPLAIN yields).
+
+Predicates are JSONPath-like expressions evaluated on the EXPLAIN output
+({"Plan": {...}, ...}); lists such as "Plans" are traversed implicitly:
+
+    .key                 member of the current nodes ($ for the root is optional)
+    ..key                member of the current nodes or any of their descendants
+    *                    any member
+    [cond && cond ...]   nodes for which all conditions hold, after . or ..
+    path op value        compare selected values, op is one of
+                         == != < <= > >= =~ (regular expression search)
+
+Values are JSON (numbers, "strings", true, false, null), anything else is taken
+as a string. A predicate holds when it selects at least one value. Examples:
+
+    ..Node Type == "Gather"
+    ..Join Type == "Anti"
+    ..[Node Type == "Seq Scan" && Plan Rows >= 1000 && Plan Rows < 5000]
+    ..[Node Type == "Hash Join"].Plans.Node Type =~ "Scan$"
+    ..Subplans Removed > 0
+"""
+
+import json
+import re
+
+import sqlreduce
+
+operator_re = re.compile(r'\s*(==|!=|<=|>=|=~|<|>)\s*')
+step_re = re.compile(r'(\.\.?)\s*(\[[^\]]*\]|[^.\[]+)')
+
+class PredicateError(Exception):
+    pass
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text.strip()
+
+def split_comparison(text):
+    """Split "path op value" at the first operator outside of brackets"""
+
+    depth = 0
+    for i, char in enumerate(text):
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif depth == 0 and (match := operator_re.match(text, i)) and match.group(1)[0] == char:
+            return text[:i].strip(), match.group(1), parse_value(text[match.end():])
+    return text.strip(), None, None
+
+def parse_path(text):
+    """Parse a path into a list of (descend, key or filter) steps"""
+
+    text = text.strip()
+    if text.startswith('$'):
+        text = text[1:]
+    if text and not text.startswith('.'):
+        text = '.' + text
+    steps = []
+    pos = 0
+    while pos < len(text):
+        match = step_re.match(text, pos)
+        if not match:
+            raise PredicateError(f"cannot parse path at: {text[pos:]}")
+        descend, key = match.groups()
+        if key.startswith('['):
+            key = [parse_predicate(cond) for cond in key[1:-1].split('&&')]
+        else:
+            key = key.strip()
+        steps.append((descend == '..', key))
+        pos = match.end()
+    return steps
+
+def parse_predicate(text):
+    """Parse "path [op value]" into (steps, op, value)"""
+
+    path, op, value = split_comparison(text)
+    return parse_path(path), op, value
+
+def flatten(values):
+    for value in values:
+        if isinstance(value, list):
+            yield from flatten(value)
+        else:
+            yield value
+
+def descendants(value):
+    """Yield value and all dicts below it"""
+
+    if isinstance(value, list):
+        for item in value:
+            yield from descendants(item)
+    elif isinstance(value, dict):
+        yield value
+        for item in value.values():
+            if isinstance(item, (list, dict)):
+                yield from descendants(item)
+
+def compare(value, op, expected):
+    if op == '=~':
+        return isinstance(value, str) and re.search(str(expected), value) is not None
+    if op == '==':
+        return value == expected
+    if op == '!=':
+        return value != expected
+    # order comparisons only between numbers, or between strings
+    if isinstance(value, bool) or isinstance(expected, bool):
+        return False
+    if not (isinstance(value, (int, float)) and isinstance(expected, (int, float)) or \
+            isinstance(value, str) and isinstance(expected, str)):
+        return False
+    if op == '<':
+        return value < expected
+    if op == '<=':
+        return value <= expected
+    if op == '>':
+        return value > expected
+    return value >= expected
+
+def select(steps, value):
+    """Return the list of values selected by steps"""
+
+    values = [value]
+    for descend, key in steps:
+        if descend:
+            nodes = [node for value in values for node in descendants(value)]
+        else:
+            nodes = [node for node in flatten(values) if isinstance(node, dict)]
+        if isinstance(key, list):
+            values = [node for node in nodes if all(evaluate(predicate, node) for predicate in key)]
+        elif key == '*':
+            values = [item for node in nodes for item in node.values()]
+        else:
+            values = [node[key] for node in nodes if key in node]
+    return list(flatten(values))
+
+def evaluate(predicate, value):
+    """Check if predicate holds for value"""
+
+    steps, op, expected = predicate
+    selected = select(steps, value)
+    if op is None:
+        return len(selected) > 0
+    return any(compare(item, op, expected) for item in selected)
+
+class PlanOracle:
+    """Check predicates on the plan of candidates"""
+
+    def __init__(self, predicates):
+        self.predicates = [parse_predicate(predicate) for predicate in predicates]
+
+    def run(self, state, query):
+        def explain(cur):
+            cur.execute(f"explain (format json) {query}")
+            return cur.fetchone()[0][0]
+
+        error, plan = sqlreduce.run_in_transaction(state, 'conn', state.database, explain)
+        if error != 'no error':
+            return error
+        if all(evaluate(predicate, plan) for predicate in self.predicates):
+            return "plan matches"
+        return "plan does not match"
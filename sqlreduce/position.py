@@ -0,0 +1,100 @@
+"""
+Ordering candidates by their distance from the error position
+
+For errors raised during parse analysis ("column does not exist", "function
+does not exist", "operator does not exist", type mismatches), PostgreSQL
+reports the position of the offending token in the query. locate() maps that
+position to the innermost parse tree node starting there, using the source
+locations pglast keeps in the tree, and stores its path in state.error_path.
+
+ordered_candidates() then tries the candidates away from that node first:
+target list entries, FROM items and CTEs that have nothing to do with the
+error go away early, while candidates replacing the error node or one of its
+ancestors (which almost always make the error go away) are left for last.
+Candidates pulling up a subtree that contains the error node remove
+everything around it at once, and are tried first of all. Otherwise, the
+enumeration order is kept: it visits large subtrees before their parts, and
+ordering by tree distance instead would try many small leaves deep inside
+unrelated subtrees before removing those subtrees as a whole.
+
+After each successful reduction, the new query is parsed again to find the
+error node from the position reported for it. Errors without a position
+(most run-time errors, crashes) leave the candidate order unchanged.
+"""
+
+import pglast
+from pglast import ast
+
+import sqlreduce
+
+def error_offset(query, position, in_bytes=False):
+    """0-based character offset in query of a 1-based error position"""
+
+    # SQL_ASCII servers count bytes instead of characters
+    if in_bytes:
+        return len(query.encode()[:position - 1].decode(errors='ignore'))
+    return position - 1
+
+def located_nodes(node, path=[]):
+    """Yield (location, path) for all nodes of a tree with a source location"""
+
+    if isinstance(node, tuple):
+        for i, item in enumerate(node):
+            yield from located_nodes(item, path + [i])
+    elif isinstance(node, ast.Node):
+        if isinstance(location := getattr(node, 'location', None), int) and location >= 0:
+            yield location, path
+        for attr in node:
+            if attr != 'location':
+                yield from located_nodes(getattr(node, attr), path + [attr])
+
+def node_at(tree, offset):
+    """Path of the innermost node starting closest before or at offset"""
+
+    best = None
+    for location, path in located_nodes(tree):
+        if location <= offset and (best is None or (location, len(path)) > (best[0], len(best[1]))):
+            best = location, path
+    return best[1] if best else None
+
+def locate(state, query, tree=None):
+    """Set state.error_path to the path of the node at the position of the last
+    error. tree is the parse tree of query, it is parsed again if not given."""
+
+    state.error_path = None
+    if state.error_position is None:
+        return
+    if tree is None:
+        try:
+            tree = pglast.parse_sql(query)
+        except pglast.parser.ParseError:
+            return
+        # paths only carry over to state.parsetree if the structure is the same
+        if sqlreduce.node_hash(tree, {}) != sqlreduce.node_hash(state.parsetree, state.hash_cache):
+            return
+    state.error_path = node_at(tree, error_offset(query, state.error_position, state.error_position_bytes))
+
+def priority(tree, error_path, path, node):
+    """Sort key of a candidate, higher is tried first: 2 when it keeps only a
+    subtree containing the error node, 1 when it does not touch the error
+    node, and 0 when it replaces the error node or one of its ancestors"""
+
+    # removing a list element affects that element only
+    affected = path
+    old = sqlreduce.getattr_path(tree, path)
+    if isinstance(node, tuple) and isinstance(old, tuple) and len(node) < len(old):
+        affected = path + [next((i for i in range(len(node)) if node[i] is not old[i]), len(node))]
+
+    if error_path[:len(affected)] != affected:
+        return 1
+    if any(node is sqlreduce.getattr_path(tree, error_path[:i]) for i in range(len(affected) + 1, len(error_path) + 1)):
+        return 2
+    return 0
+
+def ordered_candidates(state):
+    """All candidates of the current parse tree, the ones away from the error
+    node first, in enumeration order otherwise"""
+
+    tree = state.parsetree
+    candidates = [(path2, node) for path in sqlreduce.enumerate_paths(tree) for path2, node in sqlreduce.reduce_candidates(state, path)]
+    return sorted(candidates, key=lambda candidate: priority(tree, state.error_path, *candidate), reverse=True)
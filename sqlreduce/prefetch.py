@@ -0,0 +1,113 @@
+"""
+Preparing candidates while the previous one runs on the server
+
+In reduce_loop(), the client alternates between CPU work (copying the path to
+the replaced node, rendering the query, checking the seen sets) and waiting for
+the server to run the query. psycopg2 releases the GIL while waiting, so a
+producer thread can prepare the next candidates in the meantime, and the main
+thread only sends ready queries.
+
+All candidates are prepared from the current parse tree, so when a candidate
+yields the expected result, the producer is stopped before the candidate is
+accepted, and the candidates it prepared but which were not run are removed
+from the seen sets again. The next round starts from the new parse tree,
+exactly like reduce_loop() does.
+
+Early in a reduction, many candidates succeed and prepared candidates would
+mostly be thrown away, so the producer runs ahead by one candidate more for
+each candidate that failed in the current round, up to state.prefetch.
+"""
+
+import collections
+import threading
+
+import sqlreduce
+
+class Prefetcher:
+    """Thread preparing candidates of the current parse tree"""
+
+    def __init__(self, state, depth):
+        self.state = state
+        self.depth = depth
+        self.lock = threading.Condition()
+        self.items = collections.deque()
+        self.consumed = 0
+        self.stopping = False
+        self.thread = threading.Thread(target=self.produce, name='sqlreduce-prefetch', daemon=True)
+        self.thread.start()
+
+    def put(self, item, wait=True):
+        """Queue item unless stopping, returns True if queued"""
+
+        with self.lock:
+            while wait and not self.stopping and len(self.items) >= min(self.depth, self.consumed + 1):
+                self.lock.wait()
+            if self.stopping:
+                return False
+            self.items.append(item)
+            self.lock.notify_all()
+            return True
+
+    def produce(self):
+        try:
+            for path, node in sqlreduce.all_candidates(self.state):
+                if self.stopping:
+                    return
+                if candidate := sqlreduce.prepare_candidate(self.state, path, node):
+                    if not self.put(candidate):
+                        self.forget([candidate])
+                        return
+            self.put(None, wait=False)
+        except Exception as e:
+            # Cancelled or BudgetExhausted, raised in the main thread when it gets here
+            self.put(e, wait=False)
+
+    def forget(self, candidates):
+        for parsetree, query in candidates:
+            self.state.seen.discard(query)
+            self.state.seen_hashes.discard(sqlreduce.node_hash(parsetree, self.state.hash_cache))
+
+    def get(self):
+        """Return the next (parsetree, query) candidate, or None when done"""
+
+        with self.lock:
+            while not self.items:
+                self.lock.wait()
+            item = self.items.popleft()
+            self.consumed += 1
+            self.lock.notify_all()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def stop(self):
+        """Stop the producer and forget the candidates not run"""
+
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+        self.thread.join()
+        self.forget([item for item in self.items if isinstance(item, tuple)])
+        self.items.clear()
+
+def reduce_loop_prefetch(state):
+    """Like reduce_loop(), but prepare candidates in a separate thread"""
+
+    while True:
+        prefetcher = Prefetcher(state, state.prefetch)
+        try:
+            while (candidate := prefetcher.get()) is not None:
+                parsetree2, query = candidate
+                if state.verbose:
+                    print(query, end='')
+                error = sqlreduce.run_query(state, query)
+                if error == state.expected_error:
+                    # the parse tree is about to change
+                    prefetcher.stop()
+                    sqlreduce.check_candidate(state, parsetree2, query, error)
+                    break
+                sqlreduce.check_candidate(state, parsetree2, query, error)
+            else:
+                return
+        finally:
+            prefetcher.stop()
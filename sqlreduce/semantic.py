@@ -0,0 +1,96 @@
+"""
+Static pruning of candidates that break name references
+
+Many candidates can't reproduce the error because they remove something the
+rest of the query still refers to: removing a FROM item while ColumnRefs like
+ref_0.c1 still use its alias yields "missing FROM-clause entry for table", and
+removing a CTE still used in FROM yields "relation does not exist". Running
+such candidates costs a server round trip for a known outcome.
+
+The index counts, for the current parse tree, the names defined by range table
+entries (table names or aliases) and CTEs, and the qualified ColumnRefs and
+unqualified RangeVars referring to them. For a candidate, the definitions and
+references of the replaced subtree are swapped for those of the replacement;
+if a name that was defined before is still referenced but not defined anywhere
+anymore, the candidate is skipped.
+
+Scopes are not tracked, so a name defined in several places only counts as
+gone when all of its definitions are. Candidates are never skipped when the
+expected error is itself about names not being found, as breaking references
+is what reproduces it then.
+"""
+
+import collections
+import re
+
+from pglast import ast
+
+# SQL states of undefined_table, undefined_column, ambiguous_column, ambiguous_alias, duplicate_alias, invalid_column_reference
+reference_sqlstates = {'42P01', '42703', '42702', '42P09', '42712', '42P10'}
+
+reference_messages = re.compile(r'(relation|column) .* does not exist|missing FROM-clause entry|invalid reference to FROM-clause entry|is ambiguous|specified more than once')
+
+def reference_error(error):
+    """Check if error is about unknown or ambiguous names"""
+
+    return error in reference_sqlstates or bool(reference_messages.search(error))
+
+def names(node, defs=None, refs=None):
+    """Count names defined and referenced in a subtree, keyed by (namespace, name)"""
+
+    if defs is None:
+        defs, refs = collections.Counter(), collections.Counter()
+
+    if isinstance(node, tuple):
+        for item in node:
+            names(item, defs, refs)
+        return defs, refs
+    if not isinstance(node, ast.Node):
+        return defs, refs
+
+    if isinstance(node, ast.RangeVar):
+        defs[('rel', node.alias.aliasname if node.alias else node.relname)] += 1
+        if not node.schemaname:
+            refs[('cte', node.relname)] += 1
+    elif isinstance(node, (ast.RangeSubselect, ast.RangeFunction, ast.JoinExpr)) and node.alias:
+        defs[('rel', node.alias.aliasname)] += 1
+    elif isinstance(node, ast.CommonTableExpr):
+        defs[('cte', node.ctename)] += 1
+    elif isinstance(node, ast.ColumnRef) and len(node.fields) >= 2 and isinstance(node.fields[-2], ast.String):
+        refs[('rel', node.fields[-2].sval)] += 1
+
+    for attr in node:
+        names(getattr(node, attr), defs, refs)
+    return defs, refs
+
+class SemanticIndex:
+    """Name definitions and references of a parse tree"""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.defs, self.refs = names(tree)
+
+    def breaks_references(self, old, new):
+        """Check if replacing subtree old by new leaves references to names no longer defined"""
+
+        old_defs, old_refs = names(old)
+        new_defs, new_refs = names(new)
+        for key in old_defs:
+            if new_defs[key] >= old_defs[key]:
+                continue
+            defs = self.defs[key] - old_defs[key] + new_defs[key]
+            refs = self.refs[key] - old_refs[key] + new_refs[key]
+            if defs == 0 and refs > 0:
+                return True
+        return False
+
+def breaks_references(state, path, node):
+    """Check if replacing the node at path in the current parse tree by node
+    breaks name references"""
+
+    if state.semantic_index is None or state.semantic_index.tree is not state.parsetree:
+        state.semantic_index = SemanticIndex(state.parsetree)
+    old = state.parsetree
+    for p in path:
+        old = old[p] if isinstance(old, tuple) else getattr(old, p)
+    return state.semantic_index.breaks_references(old, node)
@@ -0,0 +1,323 @@
+"""
+sqlreduce serve: reduction daemon with a local job queue
+
+Starting a new sqlreduce process for each query found by a fuzzer means paying
+for importing pglast and psycopg2, and connecting to the database, every time.
+The daemon keeps a pool of worker threads, each with its own Reducer and
+database connection, and accepts reduction jobs over HTTP on localhost or on a
+Unix socket.
+
+Jobs whose input query crashes the server are reduced one at a time. Other
+jobs running at the same time still see the restarts, and may miss some
+reduction steps then; submit crash jobs to a daemon running on a separate
+server to avoid that.
+
+API (JSON):
+    POST /jobs {"query": "...", "sqlstate": false}     submit job, returns {"id": 1, ...}
+         optional: "max_time": seconds, "max_queries": n
+    GET /jobs/1                                        job status and result
+    GET /jobs/1?wait=10                                wait up to 10s for the job to finish
+    GET /jobs/1/stream                                 stream status changes and best-so-far
+                                                       queries as JSON lines
+    DELETE /jobs/1                                     cancel job
+    GET /stats                                         queue depth, latency counters
+
+    curl --unix-socket /tmp/sqlreduce.sock -d '{"query": "select 1, moo"}' http://localhost/jobs
+"""
+
+import argparse
+import http.server
+import json
+import math
+import os
+import queue
+import socketserver
+import threading
+import time
+
+from pglast.stream import RawStream
+
+import sqlreduce
+
+# number of finished jobs to keep around for polling
+keep_finished_jobs = 1000
+
+class JobQueue:
+    """Jobs and worker threads"""
+
+    def __init__(self, database, timeout, workers):
+        self.lock = threading.Condition()
+        self.jobs = {}
+        self.finished = []
+        self.next_id = 1
+        self.queue = queue.Queue()
+        self.stats = {
+                'submitted': 0,
+                'done': 0,
+                'failed': 0,
+                'cancelled': 0,
+                'queries': 0,
+                'wait_time': 0.0,
+                'max_wait_time': 0.0,
+                'run_time': 0.0,
+                'max_run_time': 0.0,
+                }
+        self.workers = []
+        # server restarts of one crash job would break the candidates of others
+        crash_lock = threading.Lock()
+        for i in range(workers):
+            reducer = sqlreduce.Reducer(database=database, timeout=timeout)
+            reducer.crash_lock = crash_lock
+            worker = threading.Thread(target=self.worker, args=(reducer,), name=f"worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, query, use_sqlstate=False, max_time=None, max_queries=None):
+        with self.lock:
+            job = {
+                    'id': self.next_id,
+                    'status': 'queued',
+                    'query': query,
+                    'sqlstate': use_sqlstate,
+                    'max_time': max_time,
+                    'max_queries': max_queries,
+                    'submitted': time.time(),
+                    'started': None,
+                    'finished': None,
+                    'best': None,
+                    'result': None,
+                    'budget_exhausted': False,
+                    'error': None,
+                    'queries': None,
+                    'exception': None,
+                    'reducer': None,
+                    }
+            self.jobs[job['id']] = job
+            self.next_id += 1
+            self.stats['submitted'] += 1
+        self.queue.put(job)
+        return job
+
+    def cancel(self, job):
+        with self.lock:
+            if job['status'] == 'queued':
+                self.finish(job, 'cancelled')
+            elif job['status'] == 'running':
+                job['status'] = 'cancelling'
+                job['reducer'].cancel()
+                self.lock.notify_all()
+
+    def finish(self, job, status):
+        """Record final job status, called with lock held"""
+
+        job['status'] = status
+        job['finished'] = time.time()
+        job['reducer'] = None
+        self.stats[status] += 1
+        if job['started']:
+            run_time = job['finished'] - job['started']
+            self.stats['run_time'] += run_time
+            self.stats['max_run_time'] = max(self.stats['max_run_time'], run_time)
+        self.finished.append(job['id'])
+        while len(self.finished) > keep_finished_jobs:
+            del self.jobs[self.finished.pop(0)]
+        self.lock.notify_all()
+
+    def progress(self, job, query):
+        with self.lock:
+            job['best'] = query
+            self.lock.notify_all()
+
+    def worker(self, reducer):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                if job['status'] != 'queued':
+                    continue
+                job['status'] = 'running'
+                job['started'] = time.time()
+                job['reducer'] = reducer
+                reducer.cancelled = False
+                reducer.use_sqlstate = job['sqlstate']
+                reducer.max_time = job['max_time']
+                reducer.max_queries = job['max_queries']
+                reducer.progress = lambda query: self.progress(job, query)
+                wait_time = job['started'] - job['submitted']
+                self.stats['wait_time'] += wait_time
+                self.stats['max_wait_time'] = max(self.stats['max_wait_time'], wait_time)
+                self.lock.notify_all()
+
+            status = 'done'
+            try:
+                job['result'] = reducer.reduce(job['query'])
+            except sqlreduce.Cancelled:
+                job['result'] = RawStream()(reducer.parsetree)
+                status = 'cancelled'
+            except Exception as e:
+                job['exception'] = str(e)
+                status = 'failed'
+
+            with self.lock:
+                if status != 'failed':
+                    job['budget_exhausted'] = reducer.budget_exhausted
+                    job['error'] = reducer.expected_error
+                    job['queries'] = len(reducer.seen)
+                    self.stats['queries'] += job['queries']
+                self.finish(job, status)
+
+    def job_info(self, job):
+        return {key: value for key, value in job.items() if key != 'reducer'}
+
+    def wait(self, job, timeout, info=None):
+        """Wait until the job is finished, or its status or best-so-far query
+        differs from info"""
+
+        deadline = time.time() + timeout
+        with self.lock:
+            while job['finished'] is None and \
+                    (info is None or (job['status'] == info['status'] and job['best'] == info['best'])):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            return self.job_info(job)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['queue_depth'] = sum(1 for job in self.jobs.values() if job['status'] == 'queued')
+            stats['running'] = sum(1 for job in self.jobs.values() if job['status'] in ('running', 'cancelling'))
+            stats['workers'] = len(self.workers)
+            started = stats['submitted'] - stats['queue_depth']
+            finished = stats['done'] + stats['failed'] + stats['cancelled']
+            stats['avg_wait_time'] = stats['wait_time'] / started if started else 0.0
+            stats['avg_run_time'] = stats['run_time'] / finished if finished else 0.0
+            return stats
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data).encode() + b'\n'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def find_job(self, job_id):
+        job = self.server.jobs.jobs.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            self.send_json({'message': 'no such job'}, 404)
+        return job
+
+    def do_GET(self):
+        path, _, args = self.path.partition('?')
+        parts = path.strip('/').split('/')
+        jobs = self.server.jobs
+
+        if parts == ['stats']:
+            self.send_json(jobs.get_stats())
+
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            if job := self.find_job(parts[1]):
+                wait = 0.0
+                try:
+                    for arg in args.split('&'):
+                        key, _, value = arg.partition('=')
+                        if key == 'wait':
+                            wait = float(value or 60)
+                            if not math.isfinite(wait):
+                                raise ValueError(value)
+                except ValueError:
+                    return self.send_json({'message': 'expected number of seconds for "wait"'}, 400)
+                self.send_json(jobs.wait(job, wait))
+
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'stream':
+            if job := self.find_job(parts[1]):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                info = jobs.job_info(job)
+                self.wfile.write(json.dumps(info).encode() + b'\n')
+                while info['finished'] is None:
+                    info = jobs.wait(job, 3600, info)
+                    self.wfile.write(json.dumps(info).encode() + b'\n')
+                    self.wfile.flush()
+
+        else:
+            self.send_json({'message': 'not found'}, 404)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.send_json({'message': 'not found'}, 404)
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            query = data['query']
+            max_time = float(data['max_time']) if data.get('max_time') is not None else None
+            max_queries = int(data['max_queries']) if data.get('max_queries') is not None else None
+        except (ValueError, KeyError, TypeError):
+            return self.send_json({'message': 'expected JSON object with "query" key'}, 400)
+        job = self.server.jobs.submit(query, use_sqlstate=bool(data.get('sqlstate')),
+                max_time=max_time, max_queries=max_queries)
+        self.send_json(self.server.jobs.job_info(job), 201)
+
+    def do_DELETE(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'jobs':
+            return self.send_json({'message': 'not found'}, 404)
+        if job := self.find_job(parts[1]):
+            self.server.jobs.cancel(job)
+            self.send_json(self.server.jobs.job_info(job))
+
+    def address_string(self):
+        # client_address is empty on Unix sockets
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve_main(argv):
+    argparser = argparse.ArgumentParser(prog="sqlreduce serve",
+            description="Run reduction jobs submitted over HTTP")
+    argparser.add_argument("-d", "--database", type=str, default="", help="Database or connection string to use")
+    argparser.add_argument("-t", "--timeout", default='500ms', help="Statement timeout [Default: 500ms]")
+    argparser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of worker threads [Default: number of CPUs]")
+    argparser.add_argument("--listen", default='127.0.0.1:8473', help="Address and port to listen on [Default: 127.0.0.1:8473]")
+    argparser.add_argument("--socket", help="Listen on Unix socket instead")
+    argparser.add_argument("-v", "--verbose", action='store_true', help="Log requests")
+    args = argparser.parse_args(argv)
+
+    if not '=' in args.database:
+        args.database = f"dbname={args.database}"
+    sqlreduce.check_connection(args.database)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixServer(args.socket, RequestHandler)
+        print(f"Listening on {args.socket} with {args.jobs} workers")
+    else:
+        host, _, port = args.listen.rpartition(':')
+        server = TCPServer((host or '127.0.0.1', int(port)), RequestHandler)
+        print(f"Listening on {host}:{port} with {args.jobs} workers")
+    server.jobs = JobQueue(args.database, args.timeout, args.jobs)
+    server.verbose = args.verbose
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.unlink(args.socket)
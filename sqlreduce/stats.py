@@ -0,0 +1,111 @@
+"""
+Server-side cost attribution via pg_stat_statements snapshots
+
+Client-side timing does not tell apart parse and plan time from execution time
+or I/O inside the server. With server_stats enabled, the Reducer snapshots
+pg_stat_statements and pg_stat_database before and after the reduction and
+attributes the server time to candidate classes.
+
+Each candidate query is remembered by its pglast fingerprint, which ignores
+constants just like the normalized query texts in pg_stat_statements do, and
+by the class of the node it reduces (e.g. "SelectStmt" or "A_Const"; "input"
+for the original query, "bulk" for bulk reductions). pg_stat_statements
+entries are mapped back to classes by fingerprinting their query text.
+BEGIN/ROLLBACK/DISCARD ALL are reported as "session", everything else that
+ran on the database in the meantime (including other clients) as "other".
+
+pg_stat_database deltas show rollbacks, temp files, and sessions abandoned
+(backend crashes) or terminated by fatal errors; a changed postmaster start
+time or stats_reset means the server restarted or its statistics were reset.
+
+pg_stat_statements has to be in shared_preload_libraries and the extension
+created in the database; without it, only the pg_stat_database counters are
+reported.
+"""
+
+from pglast.parser import fingerprint, ParseError
+
+statement_columns = ('calls', 'total_plan_time', 'total_exec_time', 'temp_blks_read', 'temp_blks_written', 'rows')
+
+def query_fingerprint(query):
+    try:
+        return fingerprint(query)
+    except ParseError:
+        return None
+
+session_fingerprints = {query_fingerprint(query): 'session' for query in ('begin', 'rollback', 'discard all')}
+
+def snapshot(cur):
+    """Read pg_stat_statements and pg_stat_database, returns a dict"""
+
+    cur.execute("select *, pg_postmaster_start_time() as postmaster_start_time from pg_stat_database where datname = current_database()")
+    database = dict(zip([column.name for column in cur.description], cur.fetchone()))
+
+    statements = None
+    cur.execute("select 1 from pg_extension where extname = 'pg_stat_statements'")
+    if cur.fetchone():
+        cur.execute(f"""select queryid, query, {', '.join(statement_columns)} from pg_stat_statements
+                where dbid = (select oid from pg_database where datname = current_database())""")
+        statements = {row[0]: row[1:] for row in cur.fetchall()}
+
+    return {'database': database, 'statements': statements}
+
+def database_delta(before, after):
+    """Differences of the numeric pg_stat_database counters"""
+
+    delta = {}
+    for key, value in after.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and key in before \
+                and key not in ('datid', 'numbackends'):
+            delta[key] = value - before[key]
+    delta['restarted'] = after['postmaster_start_time'] != before['postmaster_start_time']
+    delta['stats_reset'] = after.get('stats_reset') != before.get('stats_reset') or \
+            any(value < 0 for value in delta.values() if not isinstance(value, bool))
+    return delta
+
+def attribute(before, after, classes):
+    """Sum pg_stat_statements deltas per candidate class. classes maps query
+    fingerprints to class names."""
+
+    report = {}
+    for queryid, (query, *counters) in after.items():
+        previous = before.get(queryid)
+        if previous is not None:
+            counters = [value - old for value, old in zip(counters, previous[1:])]
+        if counters[0] <= 0:
+            continue
+        fp = query_fingerprint(query)
+        cls = classes.get(fp) or session_fingerprints.get(fp) or 'other'
+        entry = report.setdefault(cls, dict.fromkeys(('statements',) + statement_columns, 0))
+        entry['statements'] += 1
+        for column, value in zip(statement_columns, counters):
+            entry[column] += value
+    return report
+
+def report(before, after, classes):
+    """Compare two snapshots"""
+
+    result = {'database': database_delta(before['database'], after['database']), 'classes': None}
+    if before['statements'] is not None and after['statements'] is not None:
+        result['classes'] = attribute(before['statements'], after['statements'], classes)
+    return result
+
+def print_report(result):
+    database = result['database']
+    print("Server statistics:")
+    if database['restarted']:
+        print("    server restarted during the reduction")
+    elif database['stats_reset']:
+        print("    statistics were reset during the reduction (server crash?)")
+    for key in ('xact_commit', 'xact_rollback', 'temp_files', 'temp_bytes', 'deadlocks',
+                'sessions_abandoned', 'sessions_fatal', 'sessions_killed'):
+        if key in database:
+            print(f"    {key}: {database[key]}")
+
+    if result['classes'] is None:
+        print("    pg_stat_statements is not installed, no per-class attribution")
+        return
+    print(f"    {'class':<24} {'stmts':>6} {'calls':>7} {'plan ms':>10} {'exec ms':>10} {'temp rd':>8} {'temp wr':>8} {'rows':>8}")
+    for cls, entry in sorted(result['classes'].items(), key=lambda item: -item[1]['total_exec_time']):
+        print(f"    {cls:<24} {entry['statements']:>6} {entry['calls']:>7} {entry['total_plan_time']:>10.1f} {entry['total_exec_time']:>10.1f} "
+              f"{entry['temp_blks_read']:>8} {entry['temp_blks_written']:>8} {entry['rows']:>8}")
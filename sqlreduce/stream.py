@@ -0,0 +1,125 @@
+"""
+CachedStream: RawStream with a per-subtree text cache
+
+try_reduce() serializes every candidate parse tree, but candidates differ from
+the current best tree only along the path that was replaced; setattr_path()
+copies the nodes on that path and shares all other subtrees with the original
+tree. CachedStream remembers the text generated for each node object and
+replays it when the same node is printed again in the same context, so only the
+changed path from the root down to the replaced node is rendered again.
+
+The text a printer generates depends on the node itself, on its parent node
+(some printers look at the parent's type or flags), and on the output state at
+the point where the node is printed (whether a separator is pending and what
+the last character was). All of these are part of the cache key, which makes
+the output byte-identical to RawStream.
+
+The cache is a plain dict owned by the caller and shared between streams; the
+cached entries keep a reference to their node so the id() keys stay valid.
+"""
+
+from io import StringIO
+from pglast import ast
+from pglast.stream import RawStream
+from pglast.visitors import Ancestor
+
+# drop the cache when it grows larger than this many nodes
+max_cache_size = 100000
+
+def update_ancestors(ancestors, node, cache, stale):
+    """Set node.ancestors on the subtree below node like RawStream does, but
+    don't descend into nodes that are in the cache (these are remembered in
+    stale so they can be refreshed should they have to be printed after all)"""
+
+    if isinstance(node, tuple):
+        for i, subnode in enumerate(node):
+            if isinstance(subnode, (tuple, ast.Node)):
+                update_ancestors(ancestors / (node, i), subnode, cache, stale)
+        return
+
+    node.ancestors = ancestors
+    if cache is not None and id(node) in cache:
+        stale.add(id(node))
+        return
+    for attr in node:
+        value = getattr(node, attr)
+        if isinstance(value, (tuple, ast.Node)):
+            update_ancestors(ancestors / (node, attr), value, cache, stale)
+
+def parent_context(node):
+    """Return the part of the ancestor chain that printers look at: the
+    containers up to the next AST node, and that node's non-node attributes"""
+
+    context = []
+    ancestors = node.ancestors
+    while ancestors is not None and ancestors.node is not None:
+        parent = ancestors.node
+        context.append((type(parent), ancestors.member))
+        if isinstance(parent, ast.Node):
+            context.extend(getattr(parent, attr) for attr in parent
+                           if not isinstance(getattr(parent, attr), (tuple, ast.Node)))
+            break
+        ancestors = ancestors.parent
+    return tuple(context)
+
+class CachedStream(RawStream):
+    """RawStream that reuses the text of unchanged subtrees"""
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+        self.stale = set()
+
+    def __call__(self, sql):
+        if isinstance(sql, ast.Node):
+            sql = (sql,)
+        if len(self.cache) > max_cache_size:
+            self.cache.clear()
+
+        update_ancestors(Ancestor(), sql, self.cache, self.stale)
+
+        # same as RawStream.__call__
+        first = True
+        for statement in sql:
+            if isinstance(statement, ast.RawStmt) and statement.stmt is None:
+                continue
+
+            if first:
+                first = False
+            else:
+                self.write(';')
+                self.newline()
+                for _ in range(self.separate_statements):
+                    self.newline()
+            self.print_node(statement)
+
+        return self.getvalue()
+
+    def print_node(self, node, is_name=False, is_symbol=False):
+        if not isinstance(node, ast.Node):
+            return super().print_node(node, is_name, is_symbol)
+
+        key = (parent_context(node), is_name, is_symbol, self.pending_separator, self.last_emitted_char)
+        entry = self.cache.get(id(node))
+        if entry and key in entry[1]:
+            # replay cached text and output state
+            text, self.pending_separator, self.last_emitted_char = entry[1][key]
+            StringIO.write(self, text) # bypass the separator logic in OutputStream.write
+            return
+
+        # the subtree below a cached node might carry ancestors from a different tree
+        if id(node) in self.stale:
+            self.stale.discard(id(node))
+            for attr in node:
+                value = getattr(node, attr)
+                if isinstance(value, (tuple, ast.Node)):
+                    update_ancestors(node.ancestors / (node, attr), value, None, None)
+
+        start = self.tell()
+        super().print_node(node, is_name, is_symbol)
+        self.seek(start)
+        text = self.read()
+
+        if not entry:
+            entry = self.cache[id(node)] = (node, {})
+        entry[1][key] = (text, self.pending_separator, self.last_emitted_char)
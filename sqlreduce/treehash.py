@@ -0,0 +1,61 @@
+"""
+Structural hashing of parse trees
+
+prepare_candidate() used to detect duplicate candidates only after copying the
+path and rendering the candidate to SQL, because the seen set is keyed on the
+query text. Many candidates are duplicates (NULLing a node that is already
+NULL, pulling up a sole child, the same tree reached on a different path), so
+candidates are now also identified by a Merkle-style structural hash.
+
+The hash of a node combines its class, its scalar attributes and the hashes of
+its children. Hashes are cached per node object; since setattr_path() shares
+all unchanged subtrees with the original tree, the hash of a candidate can be
+computed from the cached hashes of the siblings along the replaced path alone,
+without building the candidate tree.
+
+Attributes that do not influence the generated SQL (source locations) are not
+part of the hash, so trees rendering to the same text hash the same. Hashes are
+Python hash() values of tuples; the text-keyed seen set is still maintained
+for candidates that pass the hash check.
+"""
+
+from pglast import ast
+
+# attributes ignored when hashing
+ignored_attributes = ('location', 'stmt_location', 'stmt_len')
+
+# drop the cache when it grows larger than this many nodes
+max_cache_size = 100000
+
+def node_hash(node, cache):
+    """Structural hash of a subtree. cache maps id(node) to (node, hash)."""
+
+    if isinstance(node, (tuple, ast.Node)):
+        entry = cache.get(id(node))
+        if entry is not None:
+            return entry[1]
+        if isinstance(node, tuple):
+            h = hash(('()',) + tuple(node_hash(item, cache) for item in node))
+        else:
+            h = hash((type(node).__name__,) + tuple((attr, node_hash(getattr(node, attr), cache))
+                    for attr in node if attr not in ignored_attributes))
+        # keep a reference to the node so the id stays valid
+        cache[id(node)] = (node, h)
+        return h
+    # no type name here: setting an enum attribute to an int converts it to the enum
+    return hash(('=', node))
+
+def replaced_hash(obj, path, node, cache):
+    """Structural hash of obj with the node at path replaced by node, without
+    constructing that tree"""
+
+    if path == []:
+        return node_hash(node, cache)
+    if len(cache) > max_cache_size:
+        cache.clear()
+    key = path[0]
+    if isinstance(obj, tuple):
+        return hash(('()',) + tuple(replaced_hash(item, path[1:], node, cache) if i == key else node_hash(item, cache)
+                for i, item in enumerate(obj)))
+    return hash((type(obj).__name__,) + tuple((attr, replaced_hash(getattr(obj, attr), path[1:], node, cache) if attr == key
+            else node_hash(getattr(obj, attr), cache)) for attr in obj if attr not in ignored_attributes))
@@ -0,0 +1,71 @@
+"""
+Session settings that make candidates cheaper to run
+
+Candidates run with the server's default settings, so JIT compilation,
+parallel worker startup and join order search cost time on every query, even
+when the problem being reduced has nothing to do with them. At the start of
+the reduction, choose_settings() checks which of the settings below still
+reproduce the expected outcome of the input query, and keeps those. They are
+passed as session defaults on all connections, like statement_timeout.
+
+All settings are tried at once first; if the outcome changes, they are tried
+one at a time, keeping each one that doesn't change it.
+"""
+
+import sqlreduce
+
+# (name, value) in order of expected savings
+cheap_settings = [
+    ('jit', 'off'),
+    ('max_parallel_workers_per_gather', '0'),
+    ('join_collapse_limit', '1'),
+    ('from_collapse_limit', '1'),
+    ('track_io_timing', 'off'),
+]
+
+def options(settings):
+    """Settings in the format of the connection options"""
+
+    return ' '.join(f"-c {name}={value}" for name, value in settings)
+
+def use_settings(state, settings):
+    """Make new connections use settings"""
+
+    state.session_settings = settings
+    for conn_attr in ('conn', 'pipeline_conn', 'reference_conn'):
+        if getattr(state, conn_attr):
+            getattr(state, conn_attr).close()
+            setattr(state, conn_attr, None)
+
+def run_with(state, query, settings):
+    use_settings(state, settings)
+    return sqlreduce.run_query(state, query)
+
+def available_settings(state):
+    """The cheap settings the user can set on the server"""
+
+    # unknown or superuser-only settings in the connection options would make connecting fail
+    error, names = sqlreduce.run_in_transaction(state, 'conn', state.database,
+            lambda cur: sqlreduce.settable_settings(cur, [name for name, value in cheap_settings]))
+    if error != 'no error':
+        return []
+    return [(name, value) for name, value in cheap_settings if name in names]
+
+def choose_settings(state, query):
+    """Set state.session_settings to the cheap settings that keep the expected
+    outcome of query. Returns the settings left out because they change it."""
+
+    settings = available_settings(state)
+    if settings and run_with(state, query, settings) == state.expected_error:
+        return []
+
+    chosen = []
+    rejected = []
+    for setting in settings:
+        if run_with(state, query, chosen + [setting]) == state.expected_error:
+            chosen.append(setting)
+        else:
+            rejected.append(setting)
+    if state.session_settings != chosen:
+        use_settings(state, chosen)
+    return rejected
@@ -0,0 +1,118 @@
+"""
+Watchdog for hanging queries
+
+statement_timeout does not catch every hang: backends stuck in loops that
+don't check for interrupts, candidates waiting on locks held elsewhere, or
+network stalls leave cur.execute() blocked forever. The watchdog thread tracks
+the query in flight against a hard wall-clock deadline and escalates when it is
+exceeded:
+
+    1. send a cancel request (like ^C in psql)
+    2. after grace seconds, pg_terminate_backend() from a separate connection
+    3. after another grace seconds, shut down the socket of the connection
+
+The blocked call then returns with an error, which run_in_transaction() turns
+into the outcome "hang". The query stays in the seen set, so it is never run
+again.
+
+Queries may legitimately run until the statement timeout, so the deadline
+defaults to the statement timeout plus hang_margin seconds.
+"""
+
+import os
+import re
+import socket
+import threading
+import time
+
+import psycopg2
+
+# seconds after the statement timeout until a query counts as hanging
+hang_margin = 60
+
+# units of time settings, in seconds
+units = {'us': 1e-6, 'ms': 1e-3, 's': 1, 'min': 60, 'h': 3600, 'd': 86400}
+
+def timeout_seconds(timeout):
+    """Seconds of a statement_timeout value like '500ms', None if it can't be parsed"""
+
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*(us|ms|s|min|h|d)?\s*', timeout)
+    if not match:
+        return None
+    return float(match.group(1)) * units[match.group(2) or 'ms']
+
+def default_hang_timeout(timeout):
+    """Watchdog deadline for the given statement timeout"""
+
+    return (timeout_seconds(timeout) or 0) + hang_margin
+
+class Watchdog:
+    """Deadline tracking for queries in flight"""
+
+    def __init__(self, grace=2.0):
+        self.grace = grace
+        self.lock = threading.Condition()
+        # id(conn) -> [conn, backend pid, deadline, stage, database]
+        self.watches = {}
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='sqlreduce-watchdog', daemon=True)
+        self.thread.start()
+
+    def start(self, conn, timeout, database):
+        """Start watching a query running on conn, connected to database"""
+
+        pid = conn.info.backend_pid
+        with self.lock:
+            self.watches[id(conn)] = [conn, pid, time.monotonic() + timeout, 0, database]
+            self.lock.notify()
+
+    def stop(self, conn):
+        """Stop watching conn, returns True if the watchdog had to intervene"""
+
+        with self.lock:
+            watch = self.watches.pop(id(conn), None)
+            return watch is not None and watch[3] > 0
+
+    def close(self):
+        with self.lock:
+            self.stopped = True
+            self.lock.notify()
+
+    def run(self):
+        with self.lock:
+            while not self.stopped:
+                if not self.watches:
+                    self.lock.wait()
+                    continue
+                watch = min(self.watches.values(), key=lambda watch: watch[2])
+                remaining = watch[2] - time.monotonic()
+                if remaining > 0:
+                    self.lock.wait(remaining)
+                    continue
+                self.escalate(*watch)
+                watch[3] += 1
+                watch[2] = time.monotonic() + self.grace
+
+    def escalate(self, conn, pid, deadline, stage, database):
+        """Called with lock held when the deadline of a query has passed"""
+
+        try:
+            if stage == 0:
+                conn.cancel()
+            elif stage == 1:
+                # the backend pid is only meaningful on the server conn is connected to
+                control = psycopg2.connect(database, connect_timeout=int(self.grace) + 1, fallback_application_name='sqlreduce watchdog')
+                try:
+                    control.autocommit = True
+                    control.cursor().execute("select pg_terminate_backend(%s)", (pid,))
+                finally:
+                    control.close()
+            else:
+                sock = socket.socket(fileno=os.dup(conn.fileno()))
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                finally:
+                    sock.close()
+        except Exception:
+            # try the next stage
+            pass
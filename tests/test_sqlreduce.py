@@ -1,7 +1,32 @@
 #!/usr/bin/python3
 
+import http.client
+import io
+import json
+import os
+import shutil
+import threading
+import time
 import pglast
-from sqlreduce import enumerate_paths, run_reduce, rules
+import psycopg2
+import pytest
+from pglast.stream import RawStream
+from sqlreduce import disjoint, enumerate_paths, getattr_path, null_node, pipeline_usable, Reducer, run_query, run_reduce, rules, setattr_path
+from sqlreduce.bench import count_nodes, fit_exponent, generate, run_benchmark
+from sqlreduce.cluster import Cluster
+from sqlreduce.compare import CompareOracle, fold_rows
+from sqlreduce.guard import default_profile, Guard
+from sqlreduce.ingest import ingest, read_pg_log, read_sql_log
+from sqlreduce.knowledge import KnowledgeBase
+from sqlreduce.matrix import bisect_builds, verify_matrix
+from sqlreduce.parallel import partition
+from sqlreduce.perf import classify, PerfOracle
+from sqlreduce.plan import evaluate, parse_predicate, PlanOracle
+from sqlreduce.pipeline import pipeline_available
+from sqlreduce.serve import JobQueue, RequestHandler, TCPServer
+from sqlreduce.stats import attribute, query_fingerprint
+from sqlreduce.stream import CachedStream
+from sqlreduce.treehash import node_hash, replaced_hash
 
 def test_enumerate():
     p = pglast.parse_sql('select 1')[0].stmt
@@ -20,6 +45,64 @@ def test_enumerate():
     assert [x for x in enumerate_paths(p)] == [[], ['fromClause'],
             ['fromClause', 0], ['fromClause', 0, 'subquery'], ['fromClause', 0, 'subquery', 'targetList'], ['fromClause', 0, 'subquery', 'targetList', 0], ['fromClause', 0, 'subquery', 'targetList', 0, 'val']]
 
+def test_cached_stream():
+    p = pglast.parse_sql("select a + 1, f(b, 'c') from t where x::int between 1 and 2 order by 1 desc")
+    cache = {}
+    for path in enumerate_paths(p):
+        node = getattr_path(p, path)
+        if isinstance(node, tuple):
+            candidates = [node[:i] + node[i+1:] for i in range(len(node)) if len(node) > 1]
+        else:
+            candidates = [null_node()]
+        for candidate in candidates:
+            p2 = setattr_path(p, path, candidate)
+            assert CachedStream(cache)(p2) == RawStream()(p2)
+
+def test_treehash():
+    p = pglast.parse_sql("select a + 1, f(b, 'c') from t where x::int between 1 and 2 order by 1 desc")
+    cache = {}
+    for path in enumerate_paths(p):
+        node = getattr_path(p, path)
+        for candidate in (node[1:],) if isinstance(node, tuple) else (null_node(), node):
+            assert replaced_hash(p, path, candidate, cache) == node_hash(setattr_path(p, path, candidate), cache)
+
+    # source locations are ignored
+    assert node_hash(pglast.parse_sql('select  1,2'), {}) == node_hash(pglast.parse_sql('select 1, 2'), {})
+    assert node_hash(pglast.parse_sql('select 1, 2'), {}) != node_hash(pglast.parse_sql('select 2, 1'), {})
+
+def test_ingest():
+    log = io.StringIO('''\
+2024-05-01 10:00:00.001 UTC [101] ERROR:  could not find block containing chunk 0x55d5c3e0
+2024-05-01 10:00:00.001 UTC [101] STATEMENT:  select 1 from t
+\t  where a = 1
+2024-05-01 10:00:00.002 UTC [102] ERROR:  could not find block containing chunk 0x55d5d000
+2024-05-01 10:00:00.002 UTC [102] STATEMENT:  select 2 from t where a = 2
+2024-05-01 10:00:00.003 UTC [103] ERROR:  could not find block containing chunk 0x55d5e000
+2024-05-01 10:00:00.003 UTC [103] STATEMENT:  select a from t
+2024-05-01 10:00:00.004 UTC [1] LOG:  server process (PID 104) was terminated by signal 11: Segmentation fault
+2024-05-01 10:00:00.004 UTC [1] DETAIL:  Failed process was running: select crash()
+2024-05-01 10:00:00.005 UTC [105] ERROR:  syntax error at or near "selec" at character 1
+2024-05-01 10:00:00.005 UTC [105] STATEMENT:  selec 1
+''')
+    groups, stats = ingest(read_pg_log(log), representatives=2)
+    assert stats == {'queries': 5, 'unparsable': 1, 'groups': 2}
+
+    group = groups['ERROR:  could not find block containing chunk 0x?']
+    assert group['count'] == 3
+    assert group['fingerprints'] == 2
+    assert [q for fp, q in group['queries']] == ['select a from t', 'select 2 from t where a = 2']
+
+    group = groups['CRASH: signal ?: Segmentation fault']
+    assert [q for fp, q in group['queries']] == ['select crash()']
+
+    # the last statement does not need a trailing ';'
+    reducer = Reducer()
+    log = io.StringIO('select 1;\nselect moo\n  from pg_class;\nselect 1/0\n')
+    assert list(read_sql_log(log, reducer)) == [
+            ('ERROR:  column "moo" does not exist', None, 'select moo\n  from pg_class;'),
+            ('ERROR:  division by zero', None, 'select 1/0')]
+    reducer.close()
+
 def test_select():
     # targetList
     res, _ = run_reduce('select 1, moo as foo, 3')
@@ -44,6 +127,386 @@ def test_select():
     res, _ = run_reduce("select foo('bla', 'bla')")
     assert res == 'SELECT foo(NULL, NULL)'
 
+def test_reducer():
+    reducer = Reducer()
+    assert reducer.reduce('select 1, moo as foo, 3') == 'SELECT moo AS foo'
+    assert reducer.reduce('select from pg_class, moo') == 'SELECT FROM moo'
+
+    # session state does not leak between queries
+    assert run_query(reducer, 'prepare foo as select') == 'no error'
+    assert run_query(reducer, 'prepare foo as select') == 'no error'
+
+    # a connection terminated while idle is replaced before running the query
+    conn = psycopg2.connect('')
+    conn.autocommit = True
+    conn.cursor().execute('select pg_terminate_backend(%s)', (reducer.conn.info.backend_pid,))
+    conn.close()
+    assert run_query(reducer, 'select moo') == 'ERROR:  column "moo" does not exist'
+    reducer.close()
+
+def test_budget():
+    progress = []
+    res, reducer = run_reduce('select 1, 2, 3, 4, 5, 6, 7, 8, moo', max_queries=5, progress=progress.append)
+    assert reducer.budget_exhausted
+    assert len(reducer.seen) == 5
+    assert progress and progress[-1] == res
+    assert res != 'SELECT moo'
+
+    res, reducer = run_reduce('select 1, moo', max_queries=1000)
+    assert not reducer.budget_exhausted
+    assert res == 'SELECT moo'
+
+    res, reducer = run_reduce('select 1, moo', max_time=0)
+    assert reducer.budget_exhausted
+    assert res == 'SELECT 1, moo'
+
+def test_compare():
+    rows = [(1, 'a'), (2, 'b'), (3, None)]
+    assert fold_rows(rows, 0, 0) == fold_rows(reversed(rows), 0, 0)
+    assert fold_rows(rows, 0, 0) != fold_rows(rows[:2], 0, 0)
+
+    oracle = CompareOracle("options='-c IntervalStyle=sql_standard'")
+    res, reducer = run_reduce("select g, interval '1 day'::text from generate_series(1, 100000) g where g > 5", oracle=oracle)
+    assert reducer.expected_error == 'results differ'
+    assert res == "SELECT CAST('1 day' AS interval)"
+
+    # both servers run the query at the same time, sharing one watchdog
+    reducer = Reducer(oracle=oracle)
+    assert oracle.run(reducer, 'select 1/0') == 'ERROR:  division by zero | ERROR:  division by zero'
+    assert not reducer.crashed
+    assert reducer.watchdog is not None
+    reducer.close()
+
+def test_perf():
+    assert classify([0.01], 0.1, 10) == 'fast'
+    assert classify([0.09], 0.1, 10) is None
+    assert classify([0.2, 0.21], 0.1, 10) == 'slow'
+    assert classify([0.05, 0.2, 0.08], 0.1, 3) == 'slow'
+
+    oracle = PerfOracle(threshold=0.02, runs=3)
+    res, reducer = run_reduce("select pg_sleep(0.05), count(*) from pg_class", oracle=oracle, timeout='5s')
+    assert reducer.expected_error == 'slow'
+    assert res == 'SELECT pg_sleep(0.05)'
+
+def test_plan():
+    plan = {'Plan': {'Node Type': 'Hash Join', 'Join Type': 'Anti', 'Plan Rows': 100, 'Plans': [
+        {'Node Type': 'Seq Scan', 'Plan Rows': 2000},
+        {'Node Type': 'Hash', 'Plans': [{'Node Type': 'Index Scan', 'Plan Rows': 5}]}]}}
+    assert evaluate(parse_predicate('..Node Type == "Index Scan"'), plan)
+    assert evaluate(parse_predicate('..Join Type == Anti'), plan)
+    assert evaluate(parse_predicate('$.Plan.Plan Rows < 1000'), plan)
+    assert not evaluate(parse_predicate('Plan.Plan Rows > 1000'), plan)
+    assert evaluate(parse_predicate('..[Node Type == "Seq Scan" && Plan Rows >= 1000]'), plan)
+    assert not evaluate(parse_predicate('..[Node Type == "Index Scan" && Plan Rows >= 1000]'), plan)
+    assert evaluate(parse_predicate('..[Node Type == "Hash Join"].Plans.Node Type =~ "Scan$"'), plan)
+    assert not evaluate(parse_predicate('..Subplans Removed'), plan)
+
+    oracle = PlanOracle(['..Node Type == "Sort"'])
+    res, reducer = run_reduce("select relname, 1 + 2 from pg_class where relpages > 0 order by relname", oracle=oracle)
+    assert reducer.expected_error == 'plan matches'
+    assert res == 'SELECT FROM pg_class WHERE NULL ORDER BY relname'
+
+def test_server_stats():
+    before = {1: ('SELECT $1, moo', 1, 0.1, 0.5, 0, 0, 0)}
+    after = {
+        1: ('SELECT $1, moo', 3, 0.3, 1.5, 0, 0, 0),
+        2: ('SELECT moo', 1, 0.1, 0.2, 0, 0, 0),
+        3: ('rollback', 5, 0.0, 0.1, 0, 0, 0),
+        4: ('SELECT 1 FROM pg_class', 1, 0.1, 2.0, 4, 8, 400),
+        }
+    classes = {query_fingerprint('select 1, moo'): 'input', query_fingerprint('select moo'): 'SelectStmt'}
+    report = attribute(before, after, classes)
+    assert report['input']['calls'] == 2
+    assert report['input']['total_exec_time'] == 1.0
+    assert report['SelectStmt']['statements'] == 1
+    assert report['session']['calls'] == 5
+    assert report['other']['temp_blks_written'] == 8
+
+    res, reducer = run_reduce('select 1, moo', server_stats=True)
+    assert reducer.stats_report['database']['xact_rollback'] > 0
+    assert not reducer.stats_report['database']['restarted']
+
+def test_knowledge(tmp_path):
+    queries = [f"select cast(null as circle) = 1, {i}, lower('x{i}'), {i} + 1 from pg_class where relname = 'x{i}'" for i in range(4)]
+    counts = []
+    for knowledge in (None, KnowledgeBase(str(tmp_path / 'knowledge.db'))):
+        reducer = Reducer(knowledge=knowledge)
+        count = 0
+        for query in queries:
+            assert reducer.reduce(query) == 'SELECT CAST(NULL AS circle) = 1'
+            count += len(reducer.seen)
+        counts.append(count)
+        reducer.close()
+    assert counts[1] < counts[0]
+
+    # outcomes persist across runs
+    knowledge = KnowledgeBase(str(tmp_path / 'knowledge.db'))
+    knowledge.start('ERROR:  operator does not exist: circle = integer')
+    assert knowledge.outcomes
+
+def test_confirm():
+    # nextval() makes the query fail every other time
+    conn = psycopg2.connect('')
+    conn.autocommit = True
+    conn.cursor().execute('create sequence flaky_seq start 2')
+    try:
+        res, reducer = run_reduce("select 1/(nextval('flaky_seq') % 2)::int, 2, 3", confirm=1)
+    finally:
+        conn.cursor().execute('drop sequence flaky_seq')
+        conn.close()
+    assert reducer.flaky_input == ['ERROR:  division by zero', 'no error']
+    assert reducer.confirm_failures > 0
+    assert 'nextval' in res
+
+def test_matrix():
+    error = 'ERROR:  column "moo" does not exist'
+    results = verify_matrix('select moo', ['dbname=postgres', 'port=1', ''], error)
+    assert [affected for database, affected, error in results] == [True, False, True]
+    assert results[1][2].startswith('connection failed')
+
+    first, tried = bisect_builds('select moo', ['port=1', 'port=2', '', 'dbname=postgres'], error)
+    assert first == 2
+    assert len(tried) == 2
+
+def test_guard():
+    guard = Guard.parse('temp_file_limit=10MB,max_rows=1e7')
+    assert guard.options() == '-c temp_file_limit=10MB'
+    assert guard.max_rows == 1e7
+
+    # removing the join qual would yield a cartesian product of 10^8 rows
+    query = "select a/(b-b) from generate_series(1,10000) a, generate_series(1,10000) b where a = b and a > 5"
+    res, reducer = run_reduce(query, guard=guard)
+    assert reducer.guard_trips > 0
+    assert res == 'SELECT a / (b - b) FROM generate_series(1, 10000) AS a, generate_series(1, 10000) AS b WHERE a = b'
+    # the guard is applied by run_query() only
+    assert not pipeline_usable(reducer)
+
+    # temp_file_limit would make connecting fail for non-superusers
+    conn = psycopg2.connect('')
+    conn.autocommit = True
+    conn.cursor().execute("drop role if exists sqlreduce_guard; create role sqlreduce_guard login")
+    try:
+        guard = Guard.parse(default_profile)
+        assert guard.check('user=sqlreduce_guard dbname=postgres') == ['temp_file_limit']
+        assert guard.options() == '-c work_mem=4MB'
+        res, _ = run_reduce('select 1, moo', database='user=sqlreduce_guard dbname=postgres', guard=guard)
+        assert res == 'SELECT moo'
+    finally:
+        conn.cursor().execute("drop role sqlreduce_guard")
+        conn.close()
+
+def test_watchdog():
+    # queries may run until the statement timeout
+    assert Reducer(timeout='60s').hang_timeout == 120
+    assert Reducer(timeout='500ms').hang_timeout == 60.5
+    assert Reducer(hang_timeout=None).hang_timeout is None
+
+    reducer = Reducer(timeout='10s', hang_timeout=0.5)
+    try:
+        assert run_query(reducer, 'select pg_sleep(5)') == 'hang'
+        assert reducer.hangs == 1
+        # a fresh connection is used afterwards
+        assert 'column "moo" does not exist' in run_query(reducer, 'select moo')
+        assert reducer.hangs == 1
+    finally:
+        reducer.close()
+
+@pytest.mark.skipif(not shutil.which('initdb') or os.geteuid() == 0, reason="initdb not available")
+def test_cluster(tmp_path):
+    schema = tmp_path / 'schema.sql'
+    schema.write_text('create table moo (a int);')
+    cluster = Cluster(schema=str(schema), cache_dir=str(tmp_path / 'cache'))
+    try:
+        res, _ = run_reduce('select a, 1 from moo, nosuchtable', database=cluster.start(), use_sqlstate=True)
+        assert res == 'SELECT FROM nosuchtable'
+    finally:
+        cluster.stop()
+    assert cluster.directory is None
+
+def test_parallel():
+    query = 'with a as (select 1, 2, 3), b as (select moo, 4) select * from a, b union select 1, 2, 3, 4'
+    regions = partition(pglast.parse_sql(query), 2)
+    assert len(regions) > 2
+    assert all(disjoint(path1, path2) for path1 in regions for path2 in regions if path1 is not path2)
+
+    res, reducer = run_reduce(query, jobs=2)
+    assert res == 'SELECT moo'
+    assert reducer.workers == []
+
+def test_tune():
+    # the error goes away with join_collapse_limit=1
+    query = "select 1 / (current_setting('join_collapse_limit') <> '8')::int, 2"
+    res, reducer = run_reduce(query, tune=True)
+    assert res == "SELECT 1 / CAST(current_setting('join_collapse_limit') <> '8' AS integer)"
+    assert ('jit', 'off') in reducer.session_settings
+    assert 'join_collapse_limit' not in dict(reducer.session_settings)
+
+    # track_io_timing can only be set by superusers
+    conn = psycopg2.connect('')
+    conn.autocommit = True
+    conn.cursor().execute("drop role if exists sqlreduce_tune; create role sqlreduce_tune login")
+    try:
+        res, reducer = run_reduce('select 1, moo', database='user=sqlreduce_tune dbname=postgres', tune=True)
+        assert res == 'SELECT moo'
+        assert ('jit', 'off') in reducer.session_settings
+        assert 'track_io_timing' not in dict(reducer.session_settings)
+    finally:
+        conn.cursor().execute("drop role sqlreduce_tune")
+        conn.close()
+
+def test_bench():
+    query = generate(200, depth=2, fanout=3, essential=2, placement='last')
+    assert 150 < count_nodes(query) < 250
+    assert query.endswith('f(c96, essential_0, essential_1))')
+
+    rows = run_benchmark([50, 100], essential=2)
+    assert [row['result_nodes'] for row in rows] == [8, 8]
+    assert rows[0]['queries'] < rows[1]['queries']
+    assert fit_exponent([{'nodes': 10, 'cpu': 1}, {'nodes': 100, 'cpu': 100}], 'cpu') == pytest.approx(2)
+
+def test_prefetch():
+    query = 'select a.x, b.y, 3 from (select 1 as x) a, (select 2 as y, moo) b where true'
+    res, reducer = run_reduce(query)
+    res2, reducer2 = run_reduce(query, prefetch=4)
+    assert res2 == res
+    # prefetched candidates not run were forgotten
+    assert reducer2.seen == reducer.seen
+
+    res, reducer = run_reduce(query, prefetch=4, max_queries=5)
+    assert reducer.budget_exhausted
+    assert len(reducer.seen) == 5
+
+def test_prune():
+    query = 'select ref_0.relname, ref_1.datname from pg_class as ref_0, pg_database as ref_1 where ref_0.oid = ref_1.oid and 1/0 = 1'
+    res, reducer = run_reduce(query)
+    res2, reducer2 = run_reduce(query, prune=False)
+    assert res == res2
+    assert reducer.pruned > 0
+    assert reducer2.pruned == 0
+    assert len(reducer.seen) < len(reducer2.seen)
+
+    # removing FROM items is what reproduces reference errors
+    res, reducer = run_reduce('select ref_0.relname, moo from pg_class as ref_0')
+    assert res == 'SELECT moo'
+    assert reducer.pruned == 0
+
+def test_guided():
+    query = "select ref_0.relname from pg_class as ref_0 where exists (select 1 from pg_am as ref_1 where ref_1.amname = ref_0.relname and ref_1.oid::int4 + 'x'::int = 3) and ref_0.relpages > 1 limit 10"
+    res, reducer = run_reduce(query)
+    res2, reducer2 = run_reduce(query, guided=True)
+    assert res2 == res
+    assert reducer2.error_path is not None
+    assert len(reducer2.seen) < len(reducer.seen)
+
+    # no position for run-time errors
+    res, reducer = run_reduce('select 1, 1/0', guided=True)
+    assert res == 'SELECT 1 / 0'
+    assert reducer.error_path is None
+
+def test_serve():
+    jobs = JobQueue('', '500ms', 2)
+    job1 = jobs.submit('select 1, moo as foo, 3')
+    job2 = jobs.submit('select from pg_class, moo', use_sqlstate=True)
+    assert jobs.wait(job1, 10)['result'] == 'SELECT moo AS foo'
+    info = jobs.wait(job2, 10)
+    assert info['status'] == 'done'
+    assert info['result'] == 'SELECT FROM moo'
+    assert info['error'] == '42P01'
+    stats = jobs.get_stats()
+    assert stats['done'] == 2
+    assert stats['queue_depth'] == 0
+
+    server = TCPServer(('127.0.0.1', 0), RequestHandler)
+    server.jobs = jobs
+    server.verbose = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        conn = http.client.HTTPConnection(*server.server_address)
+        conn.request('GET', f"/jobs/{job1['id']}?wait=0.1")
+        response = conn.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read())['result'] == 'SELECT moo AS foo'
+        conn.request('GET', f"/jobs/{job1['id']}?wait=abc")
+        response = conn.getresponse()
+        assert response.status == 400
+        assert 'wait' in json.loads(response.read())['message']
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_crash_lock():
+    query = 'select 1, 2, moo, 4, 5'
+    running = []
+    overlaps = []
+    lock = threading.Lock()
+
+    class CrashOracle:
+        """Pretend that queries mentioning moo crash the server"""
+        def run(self, state, query):
+            with lock:
+                overlaps.extend((query, other) for other in running)
+                running.append(query)
+            time.sleep(0.001)
+            with lock:
+                running.remove(query)
+            state.crashed = 'moo' in query
+            return 'CRASH' if state.crashed else 'no error'
+
+    crash_lock = threading.Lock()
+    reducers = [Reducer(oracle=CrashOracle(), hang_timeout=None) for i in range(2)]
+    for reducer in reducers:
+        reducer.crash_lock = crash_lock
+    threads = [threading.Thread(target=reducer.reduce, args=(query,)) for reducer in reducers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [RawStream()(reducer.parsetree) for reducer in reducers] == ['SELECT moo'] * 2
+    # only the input query, run before the crash is known, overlaps with others
+    assert all(query in pair for pair in overlaps)
+
+def test_bulk():
+    res, _ = run_reduce("select 1 + 2 + 3 + 4 + 5 + 6 + 7 + 8 + moo", bulk=True)
+    assert res == 'SELECT moo'
+
+    # failing bulk steps are bisected
+    res, _ = run_reduce("select 'a'::text as a, 'b'::text as b, foo(1::int, 2)", bulk=True)
+    assert res == 'SELECT foo(CAST(NULL AS integer), 2)'
+
+@pytest.mark.skipif(not pipeline_available(), reason="psycopg 3 not installed")
+def test_pipeline():
+    res, _ = run_reduce('select 1, moo as foo, 3', pipeline=4)
+    assert res == 'SELECT moo AS foo'
+
+    res, _ = run_reduce('select distinct foo', pipeline=4)
+    assert res == 'SELECT foo'
+
+    res, _ = run_reduce("select from pg_class, (select 1 from bar) b", use_sqlstate=True, pipeline=4)
+    assert res == 'SELECT FROM bar'
+
+    # independent reductions found in one batch are merged
+    assert disjoint([0, 'stmt', 'whereClause', 'args', 0], [0, 'stmt', 'whereClause', 'args', 1])
+    assert not disjoint([0, 'stmt', 'whereClause'], [0, 'stmt', 'whereClause', 'args', 1])
+    query = "select moo from pg_class where (1+2)::int > abs(-3) and lower('x') = upper('y') or coalesce(1, 2) > 3"
+    res, reducer = run_reduce(query, pipeline=32)
+    assert res == 'SELECT moo'
+
+    # session state like lastval() does not carry over between candidates
+    conn = psycopg2.connect('')
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("create sequence rv_seq")
+    try:
+        query = "select lastval(), nextval('rv_seq')"
+        res, _ = run_reduce(query)
+        res2, _ = run_reduce(query, pipeline=4)
+        assert res == 'SELECT lastval()'
+        assert res2 == res
+    finally:
+        cur.execute("drop sequence rv_seq")
+        conn.close()
+
 def test_rules():
     for classname, rule in rules.items():
         print(f"{classname}:")